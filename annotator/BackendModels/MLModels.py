@@ -44,9 +44,10 @@ class KhanagaModel(MLModel):
         self.trained_on_date = "March 2019"
         self.output = ''
 
-    def get_results(self, input_file):
+    def get_results(self, input_file, chunk_seconds=None, parallel=False, refine=False, target_rate=None, float_dtype='float64'):
         #results = [0,3,17,2019]
-        results = khanaga.get_results(input_file) 
+        results = khanaga.get_results(input_file, chunk_seconds=chunk_seconds, parallel=parallel, refine=refine,
+                                      target_rate=target_rate, float_dtype=float_dtype)
         self.output = ' '.join(map(str, results))
 
 class VADModel(MLModel):
@@ -58,13 +59,20 @@ class VADModel(MLModel):
         # This will store the output of the model for a given segment
         self.output = '' 
 
-    def get_results(self, input_file, threshold=0.2, window=0.5):
-        v = vad.VoiceActivityDetector(input_file, window=window, threshold=threshold)
+    def get_results(self, input_file, threshold=0.2, window=0.5, target_rate=None, float_dtype='float64'):
+        v = vad.VoiceActivityDetector(input_file, window=window, threshold=threshold, target_rate=target_rate, float_dtype=float_dtype)
         raw_detection = v.detect_speech()
         speech_labels = v.convert_windows_to_readible_labels(raw_detection)    
         # This returns a list of dicts that mark the start/end of active spans
         self.output = speech_labels
 
+    def sweep(self, input_file, thresholds, windows, target_rate=None, float_dtype='float64'):
+        v = vad.VoiceActivityDetector(input_file, target_rate=target_rate, float_dtype=float_dtype)
+        speech_labels = v.sweep(thresholds, windows)
+        # One entry per (threshold, window) setting, each with its list of active spans
+        self.output = [{"threshold": threshold, "window": window, "speech": labels}
+                       for (threshold, window), labels in speech_labels.items()]
+
 
 # class TranscriptionModel(MLModel):
     # def __init__(self):
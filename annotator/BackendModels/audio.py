@@ -0,0 +1,131 @@
+import os
+import shutil
+import subprocess
+import tempfile
+from math import gcd
+
+import numpy as np
+import scipy.io.wavfile as wf
+from scipy.signal import resample_poly
+
+# Decoded audio larger than this is spilled to an (unlinked) temporary file
+# and memory-mapped instead of being kept in memory
+DECODE_MEMMAP_BYTES = int(os.environ.get("DECODE_MEMMAP_BYTES", 256 * 1024 ** 2))
+DECODE_BLOCK_BYTES = 1 << 20
+
+
+def read_wav(filename):
+    """ Memory-maps a wav file without converting its samples, so opening
+    even a multi-hour recording costs no memory up front.
+    Output is (rate, data) where data is a read-only array in the file's own
+    dtype, of shape samples or samples x channels.
+    """
+    try:
+        return wf.read(filename, mmap=True)
+    except ValueError:
+        # e.g. 24-bit PCM, which scipy can only read into memory
+        return wf.read(filename)
+
+
+def select_channel(data, channel=0):
+    """ One channel of a samples x channels array, as a view (no copy). """
+    if data.ndim > 1:
+        return data[:, channel]
+    return data
+
+
+def mix_to_mono(data, float_dtype=np.float64):
+    """ Average of all channels, computed in float_dtype (integer samples
+    would overflow). Mono input is returned as it is. Meant to be called on
+    one window or block of samples at a time rather than on a whole file.
+    """
+    if data.ndim > 1:
+        return np.mean(data, axis=1, dtype=float_dtype)
+    return data
+
+
+def resample(sig, rate, target_rate, float_dtype=np.float64):
+    """ Decimate sig from rate to target_rate before any feature computation.
+    A polyphase FIR (Kaiser window) low-pass filter removes everything above
+    the new Nyquist frequency first, so nothing aliases into the kept band.
+    Signals already at or below target_rate are returned unchanged.
+    Output is (new_rate, new_sig), new_sig being float_dtype when resampled.
+    """
+    if not target_rate or target_rate >= rate:
+        return rate, sig
+    target_rate = int(target_rate)
+    g = gcd(int(rate), target_rate)
+    sig = resample_poly(np.asarray(sig, dtype=float_dtype), target_rate // g, int(rate) // g)
+    return target_rate, sig
+
+
+def read_pcm_stream(stream, memmap_bytes=DECODE_MEMMAP_BYTES):
+    """ Reads raw 16-bit little-endian mono PCM from a binary stream into an
+    int16 array, without an intermediate copy. Once more than memmap_bytes
+    have arrived, the rest is written to a temporary file and the output is
+    a read-only memmap of it.
+    """
+    buffer = bytearray()
+    spill = None
+    for block in iter(lambda: stream.read(DECODE_BLOCK_BYTES), b''):
+        if spill is None:
+            buffer += block
+            if len(buffer) > memmap_bytes:
+                spill = tempfile.TemporaryFile()
+                spill.write(buffer)
+                buffer = None
+        else:
+            spill.write(block)
+    if spill is None:
+        return np.frombuffer(buffer, dtype='<i2', count=len(buffer) // 2)
+    with spill:
+        spill.flush()
+        size = spill.tell() // 2
+        # the mapping stays valid after the file is closed
+        return np.memmap(spill, dtype='<i2', mode='r', shape=(size,))
+
+
+def decode(filename, target_rate=16000, memmap_bytes=DECODE_MEMMAP_BYTES):
+    """ Decodes any audio file ffmpeg can read to mono 16-bit PCM at
+    target_rate in a single pass: ffmpeg's s16le output is piped straight
+    into a numpy buffer (a memmap for very long files, see read_pcm_stream)
+    instead of going through a temporary wav file.
+    Without ffmpeg only wav files can be read; they are mixed down and
+    resampled to target_rate.
+    Output is (rate, int16 samples).
+    """
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        return decode_wav(filename, target_rate)
+    command = [ffmpeg, '-nostdin', '-v', '0', '-i', filename,
+               '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(target_rate), '-']
+    with subprocess.Popen(command, stdout=subprocess.PIPE) as process:
+        samples = read_pcm_stream(process.stdout, memmap_bytes)
+    if process.returncode != 0:
+        raise ValueError(f"ffmpeg could not decode {filename}")
+    return target_rate, samples
+
+
+def decode_wav(filename, target_rate=16000):
+    """ decode() for wav files without ffmpeg. """
+    rate, data = read_wav(filename)
+    if data.ndim == 1 and data.dtype == np.int16 and rate == target_rate:
+        return rate, data
+    dtype = data.dtype
+    data = mix_to_mono(np.asarray(data, dtype=np.float64)) * int16_scale(dtype)
+    if dtype == np.uint8:
+        data -= 128 * 256
+    if rate != target_rate:
+        # unlike resample(), this also upsamples, as ffmpeg -ar does
+        g = gcd(int(rate), int(target_rate))
+        data = resample_poly(data, int(target_rate) // g, int(rate) // g)
+    return int(target_rate), np.clip(np.round(data), -32768, 32767).astype(np.int16)
+
+
+def int16_scale(dtype):
+    """ Factor that brings samples of a wav file's dtype to the int16 range
+    (float wav files hold samples in [-1, 1], 8-bit ones are unsigned).
+    """
+    if np.issubdtype(dtype, np.floating):
+        return 32767.0
+    return 2.0 ** (16 - 8 * np.dtype(dtype).itemsize)
@@ -0,0 +1,265 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import scipy.io.wavfile as wf
+
+from .audio import mix_to_mono
+
+# Ways a cmulab.plugins backend can take a clip of audio. A plugin declares
+# the one it wants with an audio_input attribute on the object registered
+# under the entry point:
+#   AUDIO_INPUT_ARRAY: plugin(samples, params=params, sample_rate=rate), with
+#       samples a mono numpy array (a view into the decoded audio if possible)
+#   AUDIO_INPUT_FILE: plugin(wav_path, params=params), the original convention
+# A plugin can also implement a batch attribute, called with a list of clips
+# (plugin.batch(samples_list, params=params, sample_rate=rate) or
+# plugin.batch(wav_paths, params=params)) and returning one output per clip.
+AUDIO_INPUT_ARRAY = "array"
+AUDIO_INPUT_FILE = "file"
+
+# Bounds on the clips sent to a plugin's batch entry point in one call
+PLUGIN_BATCH_SIZE = int(os.environ.get("PLUGIN_BATCH_SIZE", 16))
+PLUGIN_BATCH_SECONDS = float(os.environ.get("PLUGIN_BATCH_SECONDS", 60))
+# Worker processes used by transcribe() (1 means transcribing in the calling
+# process) and the CPU threads each of them may use
+TRANSCRIPTION_WORKERS = int(os.environ.get("TRANSCRIPTION_WORKERS", 1))
+TRANSCRIPTION_THREADS_PER_WORKER = int(os.environ.get("TRANSCRIPTION_THREADS_PER_WORKER", 1))
+
+_executors = {}
+# the plugin loaded in a TranscriptionExecutor worker process
+_worker_plugin = None
+
+
+def audio_input(plugin):
+    """ The audio input a plugin declared. Plugins that do not declare one
+    were written for wav paths and keep getting them.
+    """
+    return getattr(plugin, "audio_input", AUDIO_INPUT_FILE)
+
+
+def mono_clip(clip):
+    """ clip mixed down to one channel, in its own dtype. """
+    if clip.ndim > 1 and np.issubdtype(clip.dtype, np.integer):
+        return np.round(mix_to_mono(clip)).astype(clip.dtype)
+    return mix_to_mono(clip).astype(clip.dtype, copy=False)
+
+
+def full_segment(rate, data):
+    """ A segment (times in ms, as sent by the ELAN client) covering all of data. """
+    return {'start': 0, 'end': len(data) * 1000 // rate, 'value': ""}
+
+
+def clip_samples(rate, data, start, end):
+    """ The samples of data between start and end (in ms), as a view. """
+    return data[int(start) * rate // 1000:int(end) * rate // 1000]
+
+
+def iter_clips(rate, data, segments):
+    """ Slices every segment (start and end in ms) out of data without
+    copying it. Output is (segment, clip) pairs.
+    """
+    for segment in segments:
+        yield segment, clip_samples(rate, data, segment['start'], segment['end'])
+
+
+def iter_batches(clips, rate, max_clips, max_seconds):
+    """ Groups consecutive (segment, clip) pairs into lists of at most
+    max_clips clips and max_seconds of audio. A clip longer than max_seconds
+    gets a batch of its own.
+    """
+    batch = []
+    seconds = 0.0
+    for segment, clip in clips:
+        clip_seconds = len(clip) / float(rate)
+        if batch and (len(batch) >= max_clips or seconds + clip_seconds > max_seconds):
+            yield batch
+            batch = []
+            seconds = 0.0
+        batch.append((segment, clip))
+        seconds += clip_seconds
+    if batch:
+        yield batch
+
+
+def call_plugin(plugin, clips, rate, params, tmp_dir=None, batched=False):
+    """ Outputs of plugin for a list of clips, from one call to plugin.batch
+    if batched, otherwise from one call per clip.
+    """
+    if audio_input(plugin) == AUDIO_INPUT_FILE:
+        inputs = []
+        try:
+            for clip in clips:
+                fd, clip_path = tempfile.mkstemp(suffix='.wav', dir=tmp_dir)
+                os.close(fd)
+                inputs.append(clip_path)
+                wf.write(clip_path, rate, np.asarray(clip))
+            if batched:
+                outputs = plugin.batch(inputs, params=params)
+            else:
+                outputs = [plugin(clip_path, params=params) for clip_path in inputs]
+        finally:
+            for clip_path in inputs:
+                os.remove(clip_path)
+    else:
+        inputs = [mono_clip(clip) for clip in clips]
+        if batched:
+            outputs = plugin.batch(inputs, params=params, sample_rate=rate)
+        else:
+            outputs = [plugin(samples, params=params, sample_rate=rate) for samples in inputs]
+    outputs = list(outputs)
+    if len(outputs) != len(clips):
+        raise ValueError(f"plugin returned {len(outputs)} outputs for {len(clips)} clips")
+    return outputs
+
+
+def run_on_clips(plugin, rate, data, segments, params, tmp_dir=None,
+                 max_batch_clips=PLUGIN_BATCH_SIZE, max_batch_seconds=PLUGIN_BATCH_SECONDS, progress=None):
+    """ Runs plugin on every segment of decoded audio (e.g. from
+    audio.decode). Clips go to the plugin as arrays, or as wav files written
+    to tmp_dir for plugins that need a path. Plugins with a batch entry point
+    get the clips in batches bounded by max_batch_clips and max_batch_seconds,
+    the others one clip at a time. If given, progress(results, total) is
+    called after every batch with the results so far.
+    Output is a list with one {start, end, transcription} dict per segment.
+    """
+    if not segments:
+        segments = [full_segment(rate, data)]
+    batched = callable(getattr(plugin, "batch", None))
+    if batched:
+        batches = iter_batches(iter_clips(rate, data, segments), rate, max_batch_clips, max_batch_seconds)
+    else:
+        batches = ([pair] for pair in iter_clips(rate, data, segments))
+    results = []
+    for batch in batches:
+        outputs = call_plugin(plugin, [clip for _, clip in batch], rate, params, tmp_dir, batched)
+        for (segment, _), output in zip(batch, outputs):
+            results.append({
+                    "start": segment['start'],
+                    "end": segment['end'],
+                    "transcription": output
+            })
+        if progress:
+            progress(results, len(segments))
+    return results
+
+
+def _init_worker(plugin, threads):
+    """ Runs once in every TranscriptionExecutor worker. Unpickling plugin
+    imports it (and whatever model it loads at import time) in the worker,
+    and plugin.preload(), if it has one, can load the rest.
+    """
+    global _worker_plugin
+    # the environment only reaches thread pools started from here on; the
+    # BLAS the worker inherited from its parent is limited with threadpoolctl
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(threads)
+    except ImportError:
+        pass
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    _worker_plugin = plugin
+    if callable(getattr(plugin, "preload", None)):
+        plugin.preload()
+
+
+def _call_worker_plugin(clips, rate, params, tmp_dir, batched):
+    return call_plugin(_worker_plugin, clips, rate, params, tmp_dir, batched)
+
+
+class TranscriptionExecutor():
+    """ Transcribes the segments of a file across a pool of worker processes,
+    each of which loads the plugin once and keeps it resident. Segments are
+    sent to the workers in the batches run_on_clips would use and the
+    results come back in segment order. The plugin must be picklable by
+    reference (e.g. a module-level function or class).
+    """
+
+    def __init__(self, plugin, workers=TRANSCRIPTION_WORKERS, threads_per_worker=TRANSCRIPTION_THREADS_PER_WORKER):
+        self.plugin = plugin
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                        initargs=(plugin, threads_per_worker))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+    @property
+    def broken(self):
+        """ True once a worker died (e.g. killed for running out of memory);
+        a broken pool fails every later call.
+        """
+        return bool(getattr(self.pool, "_broken", False))
+
+    def run(self, rate, data, segments, params, tmp_dir=None,
+            max_batch_clips=PLUGIN_BATCH_SIZE, max_batch_seconds=PLUGIN_BATCH_SECONDS, progress=None):
+        """ Same output as run_on_clips. """
+        if not segments:
+            segments = [full_segment(rate, data)]
+        batched = callable(getattr(self.plugin, "batch", None))
+        batches = list(iter_batches(iter_clips(rate, data, segments), rate, max_batch_clips, max_batch_seconds))
+        futures = [self.pool.submit(_call_worker_plugin, [np.asarray(clip) for _, clip in batch], rate, params, tmp_dir, batched)
+                   for batch in batches]
+        results = []
+        for batch, future in zip(batches, futures):
+            for (segment, _), output in zip(batch, future.result()):
+                results.append({
+                        "start": segment['start'],
+                        "end": segment['end'],
+                        "transcription": output
+                })
+            if progress:
+                progress(results, len(segments))
+        return results
+
+
+def get_executor(plugin, workers=TRANSCRIPTION_WORKERS, threads_per_worker=TRANSCRIPTION_THREADS_PER_WORKER):
+    """ A TranscriptionExecutor for plugin that is kept for the lifetime of
+    the process, so its workers (and their models) are reused across requests.
+    A broken one is replaced. Only for long-lived processes (web workers):
+    processes that end with os._exit, like RQ work horses, would orphan it.
+    """
+    key = (plugin, workers, threads_per_worker)
+    if key in _executors and _executors[key].broken:
+        discard_executor(plugin, workers, threads_per_worker)
+    if key not in _executors:
+        _executors[key] = TranscriptionExecutor(plugin, workers, threads_per_worker)
+    return _executors[key]
+
+
+def discard_executor(plugin, workers=TRANSCRIPTION_WORKERS, threads_per_worker=TRANSCRIPTION_THREADS_PER_WORKER):
+    executor = _executors.pop((plugin, workers, threads_per_worker), None)
+    if executor is not None:
+        executor.shutdown()
+
+
+def transcribe(plugin, rate, data, segments, params, tmp_dir=None, progress=None,
+               workers=TRANSCRIPTION_WORKERS, threads_per_worker=TRANSCRIPTION_THREADS_PER_WORKER, keep_workers=True):
+    """ run_on_clips, spread over a pool of worker processes when workers > 1.
+    With keep_workers the pool is the one get_executor keeps for the process,
+    otherwise it is started for this call and shut down at the end of it.
+    """
+    if workers <= 1:
+        return run_on_clips(plugin, rate, data, segments, params, tmp_dir, progress=progress)
+    if not keep_workers:
+        with TranscriptionExecutor(plugin, workers, threads_per_worker) as executor:
+            return executor.run(rate, data, segments, params, tmp_dir, progress=progress)
+    try:
+        return get_executor(plugin, workers, threads_per_worker).run(rate, data, segments, params, tmp_dir, progress=progress)
+    except BrokenProcessPool:
+        # do not hand the dead pool to the next request
+        discard_executor(plugin, workers, threads_per_worker)
+        raise
@@ -0,0 +1,112 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from . import clips
+from . import feature_cache
+
+# Worker processes a batch diarization job spreads its files over (1 means
+# diarizing them one after the other in the job's own process)
+DIARIZATION_WORKERS = int(os.environ.get("DIARIZATION_WORKERS", 1))
+# Default sliding window speaker embeddings are computed over, in seconds
+DIARIZATION_WINDOW_SECONDS = float(os.environ.get("DIARIZATION_WINDOW_SECONDS", 1.5))
+DIARIZATION_STEP_SECONDS = float(os.environ.get("DIARIZATION_STEP_SECONDS", 0.75))
+# Part of the feature cache key of the embeddings, next to the plugin's own version
+EMBEDDINGS_VERSION = 1
+
+# A diarization plugin is called as plugin(audio, segments, speakers), with
+# audio a wav path or, for plugins with audio_input "array", a numpy array
+# (plus sample_rate=rate). A plugin can instead split its work in two, so
+# that the expensive half is cached by audio hash and window parameters:
+#   plugin.embed(audio, window=window, step=step) returns one speaker
+#       embedding per window of the audio, as a (windows, dims) array
+#   plugin.assign(embeddings, segments, speakers, window=window, step=step,
+#       threshold=threshold) clusters them and labels them with the
+#       reference segments, returning what plugin(...) would
+# Rerunning with another threshold or other reference segments then only
+# runs assign.
+
+
+def plugin_key(plugin):
+    """ What identifies a plugin's embeddings in the cache: its import path
+    and the version it declares, if any.
+    """
+    name = getattr(plugin, "__qualname__", type(plugin).__qualname__)
+    return (getattr(plugin, "__module__", "") + "." + name, getattr(plugin, "version", None))
+
+
+def speaker_embeddings(plugin, audio, digest, window, step, sample_rate=None, cache=None):
+    """ plugin.embed for audio whose SHA-256 is digest, from the feature
+    cache (cache, by default the shared one) when it was computed before
+    with the same plugin and window parameters.
+    """
+    cache = cache or feature_cache.get_cache()
+    params = {"version": EMBEDDINGS_VERSION, "plugin": plugin_key(plugin), "window": window, "step": step}
+    if sample_rate is None:
+        compute = lambda: plugin.embed(audio, window=window, step=step)
+    else:
+        compute = lambda: plugin.embed(audio, window=window, step=step, sample_rate=sample_rate)
+    return cache.get_or_compute(None, 'speaker_embeddings', params, compute, digest=digest)
+
+
+def diarize(plugin, source, segments, speakers, params=None, cache=None, embedding_cache=None):
+    """ Runs a diarization plugin on one file. source is the SHA-256 of audio
+    in the audio cache (cache, by default the shared one) for plugins that
+    take arrays, a wav path otherwise. params may set the threshold and the
+    window and step (in seconds) of plugins that split their work.
+    """
+    params = params or {}
+    if clips.audio_input(plugin) == clips.AUDIO_INPUT_ARRAY:
+        decoded = feature_cache.decoded_audio(source, cache)
+        if decoded is None:
+            raise ValueError(f"audio {source} is no longer cached on the server, please upload it again")
+        (rate, audio) = decoded
+        digest = source
+    else:
+        (rate, audio) = (None, str(source))
+    if not (callable(getattr(plugin, "embed", None)) and callable(getattr(plugin, "assign", None))):
+        if rate is None:
+            return plugin(audio, segments, speakers)
+        return plugin(audio, segments, speakers, sample_rate=rate)
+    if rate is None:
+        digest = feature_cache.audio_hash(audio)
+    window = float(params.get("window", DIARIZATION_WINDOW_SECONDS))
+    step = float(params.get("step", DIARIZATION_STEP_SECONDS))
+    embeddings = speaker_embeddings(plugin, audio, digest, window, step, rate, embedding_cache)
+    return plugin.assign(embeddings, segments, speakers, window=window, step=step,
+                         threshold=params.get("threshold", 0.45))
+
+
+def diarize_files(plugin, files, segments, speakers, params=None, workers=DIARIZATION_WORKERS, progress=None,
+                  cache=None, embedding_cache=None):
+    """ Runs diarize on every (name, source) pair in files, across workers
+    processes if workers > 1. If given, progress(results, total) is called
+    as every file finishes with the results so far.
+    Output is a dict of results keyed by name.
+    """
+    results = {}
+    if workers > 1 and len(files) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(files))) as pool:
+            futures = {pool.submit(diarize, plugin, source, segments, speakers, params, cache, embedding_cache): name for (name, source) in files}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                if progress:
+                    progress(results, len(files))
+    else:
+        for (name, source) in files:
+            results[name] = diarize(plugin, source, segments, speakers, params, cache, embedding_cache)
+            if progress:
+                progress(results, len(files))
+    # in the order the files were sent, whichever finished first
+    return {name: results[name] for (name, _) in files}
+
+
+def unique_names(names):
+    """ names with a suffix added to repeats, so every file keeps its own result. """
+    unique = []
+    for name in names:
+        candidate, count = name, 1
+        while candidate in unique:
+            count += 1
+            candidate = f"{name} ({count})"
+        unique.append(candidate)
+    return unique
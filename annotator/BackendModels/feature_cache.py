@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+import numpy as np
+
+FEATURE_CACHE_DIR = os.environ.get("FEATURE_CACHE_DIR", "")
+FEATURE_CACHE_MAX_BYTES = int(os.environ.get("FEATURE_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+# Uploaded audio decoded to NORMALIZED_RATE mono int16, keyed by the upload's SHA-256
+AUDIO_CACHE_DIR = os.environ.get("AUDIO_CACHE_DIR", "")
+AUDIO_CACHE_MAX_BYTES = int(os.environ.get("AUDIO_CACHE_MAX_BYTES", 5 * 1024 ** 3))
+NORMALIZED_RATE = 16000
+# Part of the cache keys of decoded audio and of file_features; bump them
+# whenever a change to the decoding or the features changes their output
+PCM_VERSION = 1
+FEATURES_VERSION = 1
+
+_sha256_format = re.compile(r"^[0-9a-f]{64}$")
+_audio_hashes = {}
+_default_cache = None
+_audio_cache = None
+
+
+def sha256_of_chunks(chunks):
+    """ Hex SHA-256 of an iterable of byte strings (e.g. UploadedFile.chunks()). """
+    sha = hashlib.sha256()
+    for chunk in chunks:
+        sha.update(chunk)
+    return sha.hexdigest()
+
+
+def is_sha256(digest):
+    """ Whether digest is a hex SHA-256, as used for the cache's directory names. """
+    return isinstance(digest, str) and bool(_sha256_format.match(digest))
+
+
+def audio_hash(filename):
+    """ SHA-256 of the file contents. Remembered per (path, size, mtime) so a
+    file is only read once per process.
+    """
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+    if key not in _audio_hashes:
+        with open(filename, 'rb') as f:
+            _audio_hashes[key] = sha256_of_chunks(iter(lambda: f.read(1 << 20), b''))
+    return _audio_hashes[key]
+
+
+class FeatureCache():
+    """ Features computed from an audio file, stored as .npy sidecars under
+    cache_dir/<audio sha256>/<name>-<params hash>.npy so that every backend
+    can reuse them across requests. Arrays are returned memory-mapped.
+    When the cache grows beyond max_bytes, the least recently used files
+    are deleted (every hit refreshes a file's mtime).
+    Every method also takes the audio's SHA-256 as digest, in which case
+    filename is not needed.
+    """
+
+    def __init__(self, cache_dir, max_bytes=FEATURE_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def _path(self, filename, name, params, digest=None):
+        params = json.dumps(params, sort_keys=True, default=str)
+        params_hash = hashlib.sha1(params.encode('utf-8')).hexdigest()[:16]
+        digest = digest or audio_hash(filename)
+        if not is_sha256(digest):
+            # digests can come from clients, and name a directory
+            raise ValueError(f"invalid audio hash {digest!r}")
+        return os.path.join(self.cache_dir, digest, name + '-' + params_hash + '.npy')
+
+    def get(self, filename, name, params, digest=None):
+        """ Cached array for (audio contents, name, params), or None. """
+        path = self._path(filename, name, params, digest)
+        try:
+            array = np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return array
+
+    def put(self, filename, name, params, array, digest=None):
+        """ Stores array for (audio contents, name, params) and returns it. """
+        path = self._path(filename, name, params, digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so readers never see a partial array
+        fd, tmp_path = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.asarray(array))
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+        return array
+
+    def get_or_compute(self, filename, name, params, compute, digest=None):
+        """ Cached array if there is one, otherwise compute() is stored and returned. """
+        array = self.get(filename, name, params, digest)
+        if array is None:
+            array = self.put(filename, name, params, compute(), digest)
+        return array
+
+    def evict(self):
+        """ Deletes least recently used files until the cache fits in max_bytes. """
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self.cache_dir):
+            for f in files:
+                path = os.path.join(root, f)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+            total -= size
+
+
+def media_dir(name):
+    """ MEDIA_ROOT/name (or /tmp/name outside of Django). """
+    try:
+        from django.conf import settings
+        # Django's default MEDIA_ROOT is '', which would mean the working directory
+        media_root = getattr(settings, "MEDIA_ROOT", "") or "/tmp"
+    except Exception:
+        media_root = "/tmp"
+    return os.path.join(media_root, name)
+
+
+def get_cache():
+    """ The shared feature cache, under FEATURE_CACHE_DIR if set, otherwise
+    MEDIA_ROOT/feature_cache.
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = FeatureCache(FEATURE_CACHE_DIR or media_dir("feature_cache"))
+    return _default_cache
+
+
+def get_audio_cache():
+    """ The cache of normalized uploaded audio, under AUDIO_CACHE_DIR if set,
+    otherwise MEDIA_ROOT/audio_cache, limited to AUDIO_CACHE_MAX_BYTES.
+    """
+    global _audio_cache
+    if _audio_cache is None:
+        _audio_cache = FeatureCache(AUDIO_CACHE_DIR or media_dir("audio_cache"), AUDIO_CACHE_MAX_BYTES)
+    return _audio_cache
+
+
+def decoded_audio(digest, cache=None):
+    """ (rate, samples) of the audio whose upload had SHA-256 digest, or None
+    if it is not (or no longer) in the audio cache.
+    """
+    cache = cache or get_audio_cache()
+    samples = cache.get(None, 'pcm', {'version': PCM_VERSION, 'rate': NORMALIZED_RATE}, digest=digest)
+    if samples is None:
+        return None
+    return (NORMALIZED_RATE, samples)
+
+
+def decode_cached(filename, digest=None, cache=None):
+    """ audio.decode(filename) to NORMALIZED_RATE mono, unless the same
+    contents were decoded before. digest is the file's SHA-256 if already known.
+    Output is (rate, samples).
+    """
+    from .audio import decode
+    cache = cache or get_audio_cache()
+    samples = cache.get_or_compute(filename, 'pcm', {'version': PCM_VERSION, 'rate': NORMALIZED_RATE},
+                                   lambda: decode(filename, NORMALIZED_RATE)[1], digest=digest)
+    return (NORMALIZED_RATE, samples)
+
+
+def file_features(filename, kind='mfcc', cache=None, float_dtype=np.float64, **params):
+    """ mfcc, logfbank, ssc or powspec features of the first channel of a wav
+    file, looked up in the feature cache before computing them.
+    params are passed on to the matching function in khanaga.features, which
+    computes in float_dtype (np.float32 for single precision).
+    """
+    from .audio import read_wav, select_channel
+    from .khanaga import features
+    from .khanaga.features import sigproc
+    cache = cache or get_cache()
+
+    def compute():
+        rate, sig = read_wav(filename)
+        sig = np.asarray(select_channel(sig, 0), dtype=float_dtype)
+        if kind == 'powspec':
+            winlen = params.get('winlen', 0.025)
+            winstep = params.get('winstep', 0.01)
+            frames = sigproc.framesig(sig, winlen * rate, winstep * rate)
+            return sigproc.powspec(frames, params.get('nfft', 512))
+        return getattr(features, kind)(sig, samplerate=rate, **params)
+    key = dict(params, float_dtype=np.dtype(float_dtype).name, version=FEATURES_VERSION)
+    return cache.get_or_compute(filename, kind, key, compute)
@@ -0,0 +1,184 @@
+import glob
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.io.wavfile as wf
+
+from . import audio
+from . import clips
+
+# Worker processes that slice the recordings of a fine-tuning dataset (1
+# means slicing them one after the other in the job's own process)
+FINETUNE_PREP_WORKERS = int(os.environ.get("FINETUNE_PREP_WORKERS", 1))
+
+# Layouts a prepared dataset can have. A fine-tuning plugin declares the one
+# it reads with a dataset_format attribute (DATASET_FORMAT_WAV by default):
+#   DATASET_FORMAT_WAV: train/ and validate/ directories with one
+#       <segment_id>.wav and one <segment_id>.txt per clip
+#   DATASET_FORMAT_SHARD: train.pcm, every clip's samples back to back, and
+#       train.index.json / validate.index.json listing the id, offset,
+#       length (in samples) and transcription of their clips; read with Shard
+DATASET_FORMAT_WAV = "wav"
+DATASET_FORMAT_SHARD = "shard"
+
+
+def plugin_dataset_format(plugin):
+    return getattr(plugin, "dataset_format", DATASET_FORMAT_WAV)
+
+
+def recording_clips(wav_file):
+    """ The annotated clips of wav_file, read from the json next to it
+    ({"start-end": [transcription, ...]} with times in ms).
+    Output is (rate, [(segment_id, samples, transcription), ...]).
+    """
+    (rate, full_audio) = audio.decode(wav_file)
+    json_file = os.path.splitext(wav_file)[0] + ".json"
+    with open(json_file, 'r') as fjson:
+        transcriptions = json.load(fjson)
+    recording = []
+    for start_end in transcriptions:
+        start, end = map(int, start_end.split('-'))
+        segment_id = os.path.basename(os.path.splitext(wav_file)[0]) + '_' + start_end
+        recording.append((segment_id, clips.clip_samples(rate, full_audio, start, end), transcriptions[start_end][0]))
+    return (rate, recording)
+
+
+def slice_recording(wav_file, train_dir):
+    """ Writes one wav and one txt per annotation of wav_file to train_dir.
+    Output is the list of segment ids written.
+    """
+    (rate, recording) = recording_clips(wav_file)
+    for (segment_id, samples, transcription) in recording:
+        wf.write(os.path.join(train_dir, segment_id + ".wav"), rate, np.asarray(samples))
+        with open(os.path.join(train_dir, segment_id + ".txt"), 'w') as ftxt:
+            ftxt.write(transcription)
+    return [segment_id for (segment_id, _, _) in recording]
+
+
+def pack_recording(wav_file, part_path):
+    """ Writes the annotated clips of wav_file back to back to part_path as
+    raw int16. Output is (rate, index entries), offsets relative to the part.
+    """
+    (rate, recording) = recording_clips(wav_file)
+    entries = []
+    offset = 0
+    with open(part_path, 'wb') as f:
+        for (segment_id, samples, transcription) in recording:
+            f.write(np.ascontiguousarray(samples, dtype=np.int16).tobytes())
+            entries.append({"id": segment_id, "offset": offset, "length": len(samples), "transcription": transcription})
+            offset += len(samples)
+    return (rate, entries)
+
+
+def _write_index(data_dir, split, rate, entries):
+    index = {"audio": "train.pcm", "rate": rate, "dtype": "int16", "clips": entries}
+    with open(os.path.join(data_dir, split + ".index.json"), 'w') as f:
+        json.dump(index, f)
+
+
+class Shard():
+    """ The clips of one split of a DATASET_FORMAT_SHARD dataset. Clips are
+    (segment_id, samples, transcription), with samples a view into the
+    memory-mapped audio, so a shard is opened without reading it.
+    """
+
+    def __init__(self, data_dir, split="train"):
+        with open(os.path.join(data_dir, split + ".index.json")) as f:
+            index = json.load(f)
+        self.rate = index["rate"]
+        self.clips = index["clips"]
+        audio_path = os.path.join(data_dir, index["audio"])
+        if os.path.getsize(audio_path):
+            self.audio = np.memmap(audio_path, dtype=index["dtype"], mode='r')
+        else:
+            self.audio = np.zeros(0, dtype=index["dtype"])
+
+    def __len__(self):
+        return len(self.clips)
+
+    def __getitem__(self, i):
+        clip = self.clips[i]
+        return (clip["id"], self.audio[clip["offset"]:clip["offset"] + clip["length"]], clip["transcription"])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def link_dir(src_dir, dst_dir):
+    """ Fills dst_dir with hard links to the files of src_dir, so the same
+    data can be read from both without being stored twice. Falls back to
+    copying on filesystems without hard links.
+    """
+    os.makedirs(dst_dir, exist_ok=True)
+    for name in os.listdir(src_dir):
+        src = os.path.join(src_dir, name)
+        dst = os.path.join(dst_dir, name)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+
+def _map(fn, wav_files, outputs, workers):
+    if workers > 1 and len(wav_files) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(wav_files))) as pool:
+            return list(pool.map(fn, wav_files, outputs))
+    return [fn(wav_file, output) for (wav_file, output) in zip(wav_files, outputs)]
+
+
+def pack_dataset(wav_files, data_dir, workers=FINETUNE_PREP_WORKERS):
+    """ Writes the clips of wav_files to data_dir in DATASET_FORMAT_SHARD.
+    Every recording is packed into a part file by a worker process, then the
+    parts are joined into train.pcm. Output is the number of clips.
+    """
+    parts_dir = tempfile.mkdtemp(prefix="parts-", dir=data_dir)
+    try:
+        part_paths = [os.path.join(parts_dir, f"{i}.pcm") for i in range(len(wav_files))]
+        packed = _map(pack_recording, wav_files, part_paths, workers)
+        rate = packed[0][0] if packed else 16000
+        entries = []
+        offset = 0
+        with open(os.path.join(data_dir, "train.pcm"), 'wb') as f:
+            for part_path, (part_rate, part_entries) in zip(part_paths, packed):
+                if part_rate != rate:
+                    raise ValueError(f"{part_path} has rate {part_rate}, expected {rate}")
+                with open(part_path, 'rb') as part:
+                    shutil.copyfileobj(part, f)
+                for entry in part_entries:
+                    entries.append(dict(entry, offset=entry["offset"] + offset))
+                offset += sum(entry["length"] for entry in part_entries)
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+    # both splits index the same audio
+    _write_index(data_dir, "train", rate, entries)
+    _write_index(data_dir, "validate", rate, entries)
+    return len(entries)
+
+
+def prepare_dataset(archive_paths, data_dir, workers=FINETUNE_PREP_WORKERS, dataset_format=DATASET_FORMAT_WAV):
+    """ Unpacks the fine-tuning archives (each with train/*.wav and a json of
+    annotations per wav) and slices every recording, across workers
+    processes, into data_dir in dataset_format (see DATASET_FORMAT_WAV
+    and DATASET_FORMAT_SHARD). Validation uses the same clips, as hard links
+    or as a second index. Output is the number of clips written.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    unpack_dir = tempfile.mkdtemp(prefix="allosaurus-elan-")
+    try:
+        for archive_path in archive_paths:
+            shutil.unpack_archive(archive_path, unpack_dir)
+        wav_files = sorted(glob.glob(os.path.join(unpack_dir, "train", "*.wav")))
+        if dataset_format == DATASET_FORMAT_SHARD:
+            return pack_dataset(wav_files, data_dir, workers)
+        train_dir = os.path.join(data_dir, "train")
+        os.makedirs(train_dir, exist_ok=True)
+        segment_ids = _map(slice_recording, wav_files, [train_dir] * len(wav_files), workers)
+    finally:
+        shutil.rmtree(unpack_dir, ignore_errors=True)
+    link_dir(train_dir, os.path.join(data_dir, "validate"))
+    return sum(len(ids) for ids in segment_ids)
@@ -1,7 +1,8 @@
 # calculate filterbank features. Provides e.g. fbank and mfcc features for use in ASR applications
 # Author: James Lyons 2012
 import numpy
-from features import sigproc
+from functools import lru_cache
+from . import sigproc
 from scipy.fftpack import dct
     
 def mfcc(signal,samplerate=16000,winlen=0.025,winstep=0.01,numcep=13,
@@ -51,7 +52,7 @@ def fbank(signal,samplerate=16000,winlen=0.025,winstep=0.01,
     pspec = sigproc.powspec(frames,nfft)
     energy = numpy.sum(pspec,1) # this stores the total energy in each frame
     
-    fb = get_filterbanks(nfilt,nfft,samplerate)
+    fb = get_filterbanks(nfilt,nfft,samplerate,lowfreq,highfreq).astype(pspec.dtype, copy=False) # float32 stays float32
     feat = numpy.dot(pspec,fb.T) # compute the filterbank energies
     return feat,energy
 
@@ -93,9 +94,9 @@ def ssc(signal,samplerate=16000,winlen=0.025,winstep=0.01,
     frames = sigproc.framesig(signal, winlen*samplerate, winstep*samplerate)
     pspec = sigproc.powspec(frames,nfft)
     
-    fb = get_filterbanks(nfilt,nfft,samplerate)
+    fb = get_filterbanks(nfilt,nfft,samplerate,lowfreq,highfreq).astype(pspec.dtype, copy=False) # float32 stays float32
     feat = numpy.dot(pspec,fb.T) # compute the filterbank energies
-    R = numpy.tile(numpy.linspace(1,samplerate/2,numpy.size(pspec,1)),(numpy.size(pspec,0),1))
+    R = numpy.linspace(1,samplerate/2,numpy.size(pspec,1),dtype=pspec.dtype)
     
     return numpy.dot(pspec*R,fb.T) / feat
     
@@ -127,7 +128,13 @@ def get_filterbanks(nfilt=20,nfft=512,samplerate=16000,lowfreq=0,highfreq=None):
     :returns: A numpy array of size nfilt * (nfft/2 + 1) containing filterbank. Each row holds 1 filter.
     """
     highfreq= highfreq or samplerate/2
-    
+    return _filterbanks(nfilt,nfft,samplerate,lowfreq,highfreq)
+
+@lru_cache(maxsize=32)
+def _filterbanks(nfilt,nfft,samplerate,lowfreq,highfreq):
+    """Build the Mel-filterbank for get_filterbanks. Results are memoized, so the
+    returned array is shared between callers and marked read-only.
+    """
     # compute points evenly spaced in mels
     lowmel = hz2mel(lowfreq)
     highmel = hz2mel(highfreq)
@@ -136,12 +143,16 @@ def get_filterbanks(nfilt=20,nfft=512,samplerate=16000,lowfreq=0,highfreq=None):
     #  from Hz to fft bin number
     bin = numpy.floor((nfft+1)*mel2hz(melpoints)/samplerate)
 
-    fbank = numpy.zeros([nfilt,nfft/2+1])
-    for j in xrange(0,nfilt):
-        for i in xrange(int(bin[j]),int(bin[j+1])):
-            fbank[j,i] = (i - bin[j])/(bin[j+1]-bin[j])
-        for i in xrange(int(bin[j+1]),int(bin[j+2])):
-            fbank[j,i] = (bin[j+2]-i)/(bin[j+2]-bin[j+1])
+    # filter j rises from bin[j] to bin[j+1] and falls from bin[j+1] to bin[j+2]
+    i = numpy.arange(nfft//2+1)
+    left = bin[:-2,numpy.newaxis]
+    centre = bin[1:-1,numpy.newaxis]
+    right = bin[2:,numpy.newaxis]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        rising = numpy.where((i >= left) & (i < centre), (i - left)/(centre - left), 0.0)
+        falling = numpy.where((i >= centre) & (i < right), (right - i)/(right - centre), 0.0)
+    fbank = rising + falling
+    fbank.setflags(write=False)
     return fbank                 
     
 def lifter(cepstra,L=22):
@@ -154,5 +165,5 @@ def lifter(cepstra,L=22):
     nframes,ncoeff = numpy.shape(cepstra)
     n = numpy.arange(ncoeff)
     lift = 1+ (L/2)*numpy.sin(numpy.pi*n/L)
-    return lift*cepstra
+    return lift.astype(numpy.result_type(cepstra, numpy.float32), copy=False)*cepstra
     
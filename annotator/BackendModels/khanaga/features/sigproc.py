@@ -4,15 +4,18 @@
 import numpy
 import math
 
-def framesig(sig,frame_len,frame_step,winfunc=lambda x:numpy.ones((1,x))):
+def framesig(sig,frame_len,frame_step,winfunc=None):
     """Frame a signal into overlapping frames.
 
     :param sig: the audio signal to frame.
     :param frame_len: length of each frame measured in samples.
     :param frame_step: number of samples after the start of the previous frame that the next frame should begin.
     :param winfunc: the analysis window to apply to each frame. By default no window is applied.    
-    :returns: an array of frames. Size is NUMFRAMES by frame_len.
+    :returns: an array of frames. Size is NUMFRAMES by frame_len. Without winfunc this is a read-only
+        view into the (zero-padded) signal, so frames are not copied. Float32 signals give float32 frames.
     """
+    sig = numpy.asarray(sig)
+    dtype = sig.dtype if sig.dtype == numpy.float32 else numpy.float64
     slen = len(sig)
     frame_len = int(round(frame_len))
     frame_step = int(round(frame_step))
@@ -23,17 +26,21 @@ def framesig(sig,frame_len,frame_step,winfunc=lambda x:numpy.ones((1,x))):
         
     padlen = int((numframes-1)*frame_step + frame_len)
     
-    zeros = numpy.zeros((padlen - slen,))
-    padsignal = numpy.concatenate((sig,zeros))
+    if padlen > slen:
+        zeros = numpy.zeros((padlen - slen,), dtype=dtype)
+        padsignal = numpy.concatenate((sig,zeros))
+    else:
+        padsignal = sig
     
-    indices = numpy.tile(numpy.arange(0,frame_len),(numframes,1)) + numpy.tile(numpy.arange(0,numframes*frame_step,frame_step),(frame_len,1)).T
-    indices = numpy.array(indices,dtype=numpy.int32)
-    frames = padsignal[indices]
-    win = numpy.tile(winfunc(frame_len),(numframes,1))
-    return frames*win
+    frames = numpy.lib.stride_tricks.as_strided(padsignal, shape=(numframes,frame_len),
+                                                strides=(padsignal.strides[0]*frame_step,padsignal.strides[0]),
+                                                writeable=False)
+    if winfunc is None:
+        return frames
+    return frames*numpy.asarray(winfunc(frame_len), dtype=dtype)
     
     
-def deframesig(frames,siglen,frame_len,frame_step,winfunc=lambda x:numpy.ones((1,x))):
+def deframesig(frames,siglen,frame_len,frame_step,winfunc=None):
     """Does overlap-add procedure to undo the action of framesig. 
 
     :param frames: the array of frames.
@@ -41,28 +48,28 @@ def deframesig(frames,siglen,frame_len,frame_step,winfunc=lambda x:numpy.ones((1
     :param frame_len: length of each frame measured in samples.
     :param frame_step: number of samples after the start of the previous frame that the next frame should begin.
     :param winfunc: the analysis window to apply to each frame. By default no window is applied.    
-    :returns: a 1-D signal.
+    :returns: a 1-D signal, float32 for float32 frames.
     """
-    frame_len = round(frame_len)
-    frame_step = round(frame_step)
+    frame_len = int(round(frame_len))
+    frame_step = int(round(frame_step))
     numframes = numpy.shape(frames)[0]
     assert numpy.shape(frames)[1] == frame_len, '"frames" matrix is wrong size, 2nd dim is not equal to frame_len'
  
-    indices = numpy.tile(numpy.arange(0,frame_len),(numframes,1)) + numpy.tile(numpy.arange(0,numframes*frame_step,frame_step),(frame_len,1)).T
-    indices = numpy.array(indices,dtype=numpy.int32)
+    indices = numpy.arange(0,numframes*frame_step,frame_step)[:,numpy.newaxis] + numpy.arange(0,frame_len)
     padlen = (numframes-1)*frame_step + frame_len   
     
     if siglen <= 0: siglen = padlen
     
-    rec_signal = numpy.zeros((1,padlen))
-    window_correction = numpy.zeros((1,padlen))
-    win = winfunc(frame_len)
+    win = numpy.ones(frame_len) if winfunc is None else winfunc(frame_len)
+    win = numpy.broadcast_to(win + 1e-15, (numframes,frame_len)) #add a little bit so it is never zero
     
-    for i in range(0,numframes):
-        window_correction[indices[i,:]] = window_correction[indices[i,:]] + win + 1e-15 #add a little bit so it is never zero
-        rec_signal[indices[i,:]] = rec_signal[indices[i,:]] + frames[i,:]
+    # overlap-add every frame at once; bincount sums the samples that share an index
+    rec_signal = numpy.bincount(indices.ravel(), weights=numpy.ravel(frames), minlength=padlen)
+    window_correction = numpy.bincount(indices.ravel(), weights=win.ravel(), minlength=padlen)
         
     rec_signal = rec_signal/window_correction
+    if numpy.asarray(frames).dtype == numpy.float32:
+        rec_signal = rec_signal.astype(numpy.float32)
     return rec_signal[0:siglen]
     
 def magspec(frames,NFFT):
@@ -73,7 +80,9 @@ def magspec(frames,NFFT):
     :returns: If frames is an NxD matrix, output will be NxNFFT. Each row will be the magnitude spectrum of the corresponding frame.
     """    
     complex_spec = numpy.fft.rfft(frames,NFFT)
-    return numpy.absolute(complex_spec)
+    # NumPy < 2 computes rfft in double precision whatever the input
+    dtype = numpy.float32 if numpy.asarray(frames).dtype == numpy.float32 else numpy.float64
+    return numpy.absolute(complex_spec).astype(dtype, copy=False)
           
 def powspec(frames,NFFT):
     """Compute the power spectrum of each frame in frames. If frames is an NxD matrix, output will be NxNFFT. 
@@ -1,7 +1,19 @@
 import numpy as np
-import scipy.io.wavfile as wav
 from scipy.signal import butter, lfilter, freqz
-from scipy.stats import norm
+from concurrent.futures import ProcessPoolExecutor
+from ..audio import read_wav, resample, select_channel
+from ..feature_cache import get_cache
+
+# Low-pass filter used for the second boundary detection pass
+LOWPASS_ORDER = 6
+LOWPASS_CUTOFF = 1800  # desired cutoff frequency of the filter, Hz
+
+# Part of the feature cache key of the boundaries; bump it whenever a change
+# to the boundary detection changes its output
+BOUNDARIES_VERSION = 3
+
+# Shortest segment the LLRT refinement keeps, in seconds
+REFINE_MIN_SEGMENT_SECONDS = 0.01
 
 # Functions for low-pass filter
 def butter_lowpass(cutoff, fs, order=5):
@@ -15,37 +27,41 @@ def butter_lowpass_filter(data, cutoff, fs, order=5):
 	y = lfilter(b, a, data)
 	return y
 
-# Compute ACC
-def compute_ACC(sig, rate):
-	Gamma_mu_0 = np.zeros([len(sig)])
-	Gamma_mu_1 = np.zeros([len(sig)])
-	Gamma_rho_kappa = np.zeros([len(sig)])
-	kappa_tau = np.zeros([len(sig)])
-	rho_0 = 1.0/rate
+# Per-sample terms of ACC for sig: rho_0, Gamma_mu_0 (for every sample) and
+# Gamma_rho_kappa (for samples 1..N-2), all in float_dtype.
+def ACC_terms(sig, rate, float_dtype=np.float64):
+	# Work in floating point so that int16 PCM differences cannot wrap around
+	sig = np.asarray(sig, dtype=float_dtype)
+	N = len(sig)
+	# a float_dtype scalar, so that it does not promote float32 arrays
+	rho_0 = sig.dtype.type(1.0/rate)
 	#print "rho_0:", rho_0, np.log(rho_0)
 
-	for n in range(1,len(sig)):
-		Gamma_mu_0[n] = np.abs(sig[n]-sig[n-1])
-		if (Gamma_mu_0[n] == 0):
-			Gamma_mu_0[n] = 0.0001
+	# |sig[n]-sig[n-1]| for n = 1..N-1, Gamma_mu_0[0] stays 0
+	d = np.abs(np.diff(sig))
+	Gamma_mu_0 = np.zeros([N], dtype=sig.dtype)
+	Gamma_mu_0[1:] = np.where(d == 0, 0.0001, d)
 	#Gamma_mu_0[0] = sig[0]
-	for n in range(1,len(sig)-1):
-		Gamma_mu_1[n] = np.abs(sig[n]-sig[n-1]) + np.abs(sig[n+1] - sig[n])
-		if (Gamma_mu_1[n] == 0):
-			Gamma_mu_1[n] = 0.0001
-	#Gamma_mu_1[0] = 0.0001
-	#Gamma_mu_1[(len(sig)-1)] = 0.0001
-	for n in range(1,len(sig)-1):
-		kappa_tau[n] = np.sqrt(np.divide(Gamma_mu_1[n],Gamma_mu_0[n]))
-		if (kappa_tau[n] == 0):
-			kappa_tau[n] = 0.0001
-
-	Gamma_rho_kappa = np.multiply(kappa_tau,Gamma_mu_0)
-	Gamma_rho_kappa = Gamma_rho_kappa[1:len(sig)-1]
-
-	temp = np.average(Gamma_mu_0)
-
-	h = np.zeros([len(Gamma_rho_kappa)])
+	# |sig[n]-sig[n-1]| + |sig[n+1]-sig[n]| for n = 1..N-2
+	Gamma_mu_1 = d[:-1] + d[1:]
+	Gamma_mu_1 = np.where(Gamma_mu_1 == 0, 0.0001, Gamma_mu_1)
+	kappa_tau = np.sqrt(Gamma_mu_1 / Gamma_mu_0[1:N-1])
+	kappa_tau = np.where(kappa_tau == 0, 0.0001, kappa_tau)
+
+	Gamma_rho_kappa = kappa_tau * Gamma_mu_0[1:N-1]
+	return (rho_0, Gamma_mu_0, Gamma_rho_kappa)
+
+# Compute ACC. float_dtype=np.float32 keeps every intermediate array in
+# single precision (only the running sum is accumulated in float64).
+# ACC is normalised with the mean of Gamma_mu_0, the mean of h and the
+# maximum of ACC over sig, or with the (temp, h_bar, ACC_max) of stats when
+# sig is one window of a longer signal (see ACC_stats).
+def compute_ACC(sig, rate, float_dtype=np.float64, stats=None):
+	(rho_0, Gamma_mu_0, Gamma_rho_kappa) = ACC_terms(sig, rate, float_dtype)
+	dtype = Gamma_mu_0.dtype.type
+
+	temp = np.average(Gamma_mu_0) if stats is None else dtype(stats[0])
+
 	h = (np.log(Gamma_rho_kappa) - np.log(temp)) / np.log(rho_0)
 
 	'''
@@ -53,18 +69,17 @@ def compute_ACC(sig, rate):
 	plt.subplot(2, 1, 1)
 	plt.plot(x,h)
 	'''
-	h_bar = np.average(h)
+	h_bar = np.average(h) if stats is None else dtype(stats[1])
 	#print h_bar
 	h_help = h - h_bar
 	#print h_help[:10]
-	ACC = np.zeros([len(h)-1])
 	print(f"Computing ACC for up to length {len(h)}")
-	for n in range(1,len(h)):
-		ACC[n-1] = np.sum(h_help[:n])
+	# ACC[n-1] = sum(h_help[:n]) for n = 1..len(h)-1
+	ACC = np.cumsum(h_help, dtype=np.float64)[:-1].astype(Gamma_mu_0.dtype, copy=False)
 	
 	#print len(x), len(h), len(ACC)
 	# Normalise ACC to unity
-	ACC = ACC / np.max(ACC)
+	ACC = ACC / (np.max(ACC) if stats is None else dtype(stats[2]))
 	
 	# Plot ACC
 	'''
@@ -99,49 +114,93 @@ def MSE2(sig,x1,x2):
 	dif = sig - lin
 	return np.mean(np.power(dif,2))
 
+# Prefix sums over ACC[start:stop] for O(1) segment errors with segment_MSE.
+# The window is shifted to start at zero and indexed locally, which keeps the
+# sums small (MSE does not change when the signal is shifted by a constant).
+# The sums are float64 even for a float32 ACC, since the expanded squared
+# error in segment_MSE cancels badly in single precision.
+def segment_sums(ACC, start, stop):
+	b = np.asarray(ACC[start:stop] - ACC[start], dtype=np.float64)
+	j = np.arange(len(b))
+	P0 = np.concatenate(([0.0], np.cumsum(b)))
+	P1 = np.concatenate(([0.0], np.cumsum(j * b)))
+	P2 = np.concatenate(([0.0], np.cumsum(b * b)))
+	return (b, P0, P1, P2)
+
+# Same value as MSE(ACC[x1:x2], x1, x2), for arrays of window-local x1, x2
+def segment_MSE(sums, x1, x2):
+	b, P0, P1, P2 = sums
+	x1 = np.asarray(x1)
+	x2 = np.asarray(x2)
+	L = (x2 - x1).astype(np.float64)
+	y1 = b[np.minimum(x1, len(b)-1)]
+	y2 = b[np.maximum(x2-1, 0)]
+	slope = (y2 - y1) / (L + 1)
+	S0 = P0[x2] - P0[x1]
+	# sum of (x - x1) * sig over the segment
+	SJ = (P1[x2] - P1[x1]) - x1 * S0
+	S2 = P2[x2] - P2[x1]
+	sse = (S2 - 2*y1*S0 + L*y1*y1
+		- 2*slope*SJ + slope*y1*L*(L-1)
+		+ slope*slope*(L-1)*L*(2*L-1)/6.0)
+	return np.where(L > 0, sse / np.maximum(L, 1), 0.0)
+
 # PLA algorithm for boundary detection
-def PLA(ACC, epsilon):
+def PLA(ACC, epsilon, horizon=1024):
 	N = len(ACC)
-	i = 1
 	c = [1]
 	k1 = 3
-	prev = 0
 	while (k1 < N):
-		#print MSE(ACC[c[i-1]:k1], c[i-1], k1)
-		if (MSE(ACC[c[i-1]:k1], c[i-1], k1) > epsilon):
-			#print MSE(ACC[c[i-1]:k1], c[i-1], k1)
-			#print k1
-			ni = k1
-			l = ni - c[i-1]
-			E2 = np.empty([l])
-			for k2 in range(l):
-				E2[k2] = MSE(ACC[c[i-1]:c[i-1]+k2], c[i-1], c[i-1]+k2) + MSE(ACC[c[i-1]+k2:k1], c[i-1]+k2, k1)
-			ci = np.argmin(E2) + c[i-1]
-			c.append(ci)
-			#print c
-			#prev = k1
-			k1 = c[i]
-			i += 1
-		k1 += 1
-		#if (prev == k1):
-		#	break
+		s = c[-1]
+		# Grow the window from s until its error first exceeds epsilon,
+		# looking ahead horizon samples at a time
+		h = horizon
+		while True:
+			stop = min(s + h, N)
+			sums = segment_sums(ACC, s, stop)
+			ends = np.arange(k1, stop)
+			over = np.flatnonzero(segment_MSE(sums, 0, ends - s) > epsilon)
+			if len(over) > 0:
+				k1 = int(ends[over[0]])
+				break
+			if stop == N:
+				return c
+			k1 = stop
+			h *= 2
+		# Best split point of ACC[s:k1], all candidates at once
+		l = k1 - s
+		k2 = np.arange(l)
+		E2 = segment_MSE(sums, 0, k2) + segment_MSE(sums, k2, l)
+		ci = int(np.argmin(E2)) + s
+		c.append(ci)
+		k1 = ci + 1
 	return c
 
+# Number of boundaries matched to a distinct gold boundary less than window
+# samples away. Both lists are sorted and matched greedily left to right,
+# each boundary taking the earliest unmatched gold boundary in range; gold
+# boundaries left behind can never be reached by a later boundary, so a
+# single pointer over the searchsorted ranges is enough.
+def count_hits(bounds, gold, window):
+	bounds = np.sort(np.asarray(bounds, dtype=np.float64))
+	gold = np.sort(np.asarray(gold, dtype=np.float64))
+	lo = np.searchsorted(gold, bounds - window, side='right')
+	hi = np.searchsorted(gold, bounds + window, side='left')
+	NH = 0
+	p = 0
+	for (l, h) in zip(lo.tolist(), hi.tolist()):
+		p = max(p, l)
+		if p < h:
+			NH += 1
+			p += 1
+	return NH
+
 # Function fo compute the partial performance measures
 def partial(bounds, gold, tolerance, rate):
 	NR = float(len(gold))
 	NT = float(len(bounds))
 	window = tolerance * rate / 1000.0 #tolerance is given in ms
-	NH = 0.0
-	gold2 = list(gold)
-	for b in bounds:
-		#print b
-		for g in gold2[:]:
-			if (np.abs(g-b) < window):
-				gold2.remove(g)
-				NH += 1.0
-				print("Correct boundary:"+ +str(b)+ "(gold: "+ str(g)+ ")")
-				break
+	NH = float(count_hits(bounds, gold, window))
 	# Measures
 	HR = NH / NR
 	OS = (NT - NR) / NR
@@ -149,57 +208,231 @@ def partial(bounds, gold, tolerance, rate):
 
 	return (HR,OS,FA)
 
-# Function to compute LLRT
-def LLRT(Z, X, Y):
-	
-	H0 = np.sum(norm.pdf(Z,np.mean(Z),np.std(Z)))
-	print("H0:"+ str(H0))
-	H1 = np.sum(norm.pdf(X,np.mean(X),np.std(X))) + np.sum(norm.pdf(Y,np.mean(Y),np.std(Y)))
-	print("H1:" + str(H1))
-	Ratio = np.log(H0 / H1)
-	print("Ratio:" + str(Ratio))
-	if Ratio > -0.1:
-		return False
-	else:
-		return True
-
-def refineBoundaries(bounds, SE):
-	c = list(bounds)
-	c.sort()
-	print(c)
-	candidates = [c[0]]
-	i = 8
-	while (i < len(c)-1):
-		if LLRT(SE[c[i-1]:c[i+1]], SE[c[i-1]:c[i]], SE[c[i]:c[i+1]]):
-			candidates.append(c[i])
-			i += 1
-		else:
-			# LLR test showed there shouldn't be a boundary here, do nothing
-			c.remove(c[i])
-		print(len(c))
-		print(c)
-	return candidates
-
-def get_results(filename):
-	# Read input
-	(rate,sig) = wav.read(filename)
+# F1 from hit rate (recall) and false alarm rate (1 - precision)
+def F1(HR, FA):
+	if (1-FA+HR) == 0:
+		return 0.0
+	return 2*(1-FA)*HR / (1-FA+HR)
+
+# Score a whole corpus for each tolerance (in ms) in one call. bounds_list and
+# gold_list hold one list of boundaries (in samples) per file. Files are laid
+# end to end with a gap wider than any window, so a single searchsorted pass
+# covers all of them. Returns an array with one (HR, OS, FA, F1) row per
+# tolerance, computed from hit and boundary counts pooled over all files.
+def batch_partial(bounds_list, gold_list, tolerances, rate):
+	tolerances = np.atleast_1d(np.asarray(tolerances, dtype=np.float64))
+	rates = np.broadcast_to(np.asarray(rate, dtype=np.float64), (len(bounds_list),))
+	# keep every file in milliseconds so that one window fits all of them
+	bounds_ms = [np.asarray(b, dtype=np.float64) * 1000.0 / r for (b, r) in zip(bounds_list, rates)]
+	gold_ms = [np.asarray(g, dtype=np.float64) * 1000.0 / r for (g, r) in zip(gold_list, rates)]
+	gap = 2 * tolerances.max() + 1
+	offset = 0.0
+	all_bounds, all_gold = [], []
+	for (b, g) in zip(bounds_ms, gold_ms):
+		start = min(b.min(initial=0), g.min(initial=0))
+		stop = max(b.max(initial=0), g.max(initial=0))
+		all_bounds.append(b - start + offset)
+		all_gold.append(g - start + offset)
+		offset += stop - start + gap
+	all_bounds = np.concatenate(all_bounds) if all_bounds else np.zeros(0)
+	all_gold = np.concatenate(all_gold) if all_gold else np.zeros(0)
+	NR = float(len(all_gold))
+	NT = float(len(all_bounds))
+	scores = np.empty([len(tolerances), 4])
+	for (i, tolerance) in enumerate(tolerances):
+		NH = float(count_hits(all_bounds, all_gold, tolerance))
+		HR = NH / NR
+		OS = (NT - NR) / NR
+		FA = (NT - NH) / NT
+		scores[i] = (HR, OS, FA, F1(HR, FA))
+	return scores
+
+# Function to compute LLRT for every candidate boundary at once.
+# S1 and S2 are prefix sums of the signal and its square (with a leading 0),
+# so the mean and std of any segment come out in O(1). Returns the Gaussian
+# log-likelihood ratio of splitting sig[c[i-1]:c[i+1]] at c[i] versus keeping
+# it as one segment, for i = 1..len(c)-2.
+def LLRT(S1, S2, c):
+	c = np.asarray(c)
+	def loglik(x1, x2):
+		n = x2 - x1
+		mean = (S1[x2] - S1[x1]) / n
+		var = np.maximum((S2[x2] - S2[x1]) / n - mean * mean, 1e-12)
+		# maximised Gaussian log-likelihood, up to a constant that cancels
+		return -0.5 * n * np.log(var)
+	return loglik(c[:-2], c[1:-1]) + loglik(c[1:-1], c[2:]) - loglik(c[:-2], c[2:])
+
+# Drop boundaries whose split is not supported by the LLRT on SE.
+# A boundary is kept when its ratio beats a BIC-style penalty of
+# penalty * log(n), n being the length of the merged segment. All boundaries
+# are scored together; in each round the weakest rejected boundary of every
+# run of neighbouring rejections is removed, then the rest are re-scored.
+# A boundary that leaves a segment shorter than min_length samples is always
+# rejected: the variance of a few samples can be close to zero, which gives
+# their split a likelihood no penalty outweighs. Of a run of such boundaries,
+# the one with the strongest ratio is the last to go.
+def refineBoundaries(bounds, SE, penalty=1.0, min_length=16):
+	c = np.unique(np.clip(np.asarray(bounds, dtype=int), 0, len(SE)))
+	S1 = np.concatenate(([0.0], np.cumsum(SE, dtype=np.float64)))
+	S2 = np.concatenate(([0.0], np.cumsum(np.square(SE), dtype=np.float64)))
+	while len(c) > 2:
+		Ratio = LLRT(S1, S2, c)
+		short = np.minimum(c[1:-1] - c[:-2], c[2:] - c[1:-1]) < min_length
+		reject = short | (Ratio <= penalty * np.log(c[2:] - c[:-2]))
+		if not reject.any():
+			break
+		# never remove two neighbouring boundaries in the same round
+		prev_reject = np.concatenate(([False], reject[:-1]))
+		next_reject = np.concatenate((reject[1:], [False]))
+		prev_ratio = np.concatenate(([np.inf], Ratio[:-1]))
+		next_ratio = np.concatenate((Ratio[1:], [np.inf]))
+		remove = reject & (~prev_reject | (Ratio < prev_ratio)) & (~next_reject | (Ratio <= next_ratio))
+		c = np.concatenate(([c[0]], c[1:-1][~remove], [c[-1]]))
+	return [int(b) for b in c]
+
+# Read a WAV file as a memory-mapped array, keeping only the left channel
+def read_signal(filename):
+	(rate,sig) = read_wav(filename)
 	print(f"The wav file has a {rate} rate and {sig.shape} length")
 	if len(sig.shape) > 1:
 		print(f"The file has stereo audio -- will use the left channel for VAD")
-		sig = sig[:,0]
-	(SE1,ACC1) = compute_ACC(sig,rate)
-	# Use Lowpass filter
-	order = 6
-	cutoff = 1800  # desired cutoff frequency of the filter, Hz
-	lowsig = butter_lowpass_filter(sig, cutoff, rate, order)
-
-	# Compute ACC on filtered version
-	(SE2,ACC2) = compute_ACC(lowsig,rate)
-	
+		sig = select_channel(sig, 0)
+	return (rate,sig)
+
+# Yield (offset, start, stop, chunk) for overlapping windows over sig.
+# Each window covers the core [start, stop) plus up to overlap samples on
+# either side, and chunk[0] is sample number offset of the whole signal.
+# If lowpass is set, the low-pass filter runs over the signal once, with its
+# state carried from one window to the next, so chunks are filtered exactly
+# as if the whole signal had been filtered in one go (in float_dtype).
+def iter_chunks(sig, rate, chunk_size, overlap, lowpass=False, float_dtype=np.float64):
+	N = len(sig)
+	if lowpass:
+		b, a = butter_lowpass(LOWPASS_CUTOFF, rate, order=LOWPASS_ORDER)
+		if float_dtype != np.float64:
+			b, a = b.astype(float_dtype), a.astype(float_dtype)
+		zi = np.zeros(max(len(a), len(b)) - 1, dtype=float_dtype)
+		filtered = np.zeros(0, dtype=float_dtype)
+		filtered_start = 0
+	for start in range(0, max(N, 1), chunk_size):
+		stop = min(start + chunk_size, N)
+		offset = max(start - overlap, 0)
+		end = min(stop + overlap, N)
+		if lowpass:
+			# filter only the samples not seen yet, keep the overlapping tail
+			filtered_stop = filtered_start + len(filtered)
+			(fresh, zi) = lfilter(b, a, np.asarray(sig[filtered_stop:end], dtype=float_dtype), zi=zi)
+			filtered = np.concatenate((filtered[offset-filtered_start:], fresh))
+			filtered_start = offset
+			chunk = filtered
+		else:
+			chunk = sig[offset:end]
+		yield (offset, start, stop, chunk)
+
+# The (temp, h_bar, ACC_max) that compute_ACC would normalise the whole
+# signal with, gathered over the cores of the windows that find_boundaries
+# processes, so that every window of a chunked pass is normalised alike.
+# h_bar and the running sum of ACC need the mean of Gamma_mu_0 first, so
+# the windows are read twice; only one window is held at a time.
+def ACC_stats(sig, rate, chunk_size, overlap, lowpass=False, target_rate=None, float_dtype=np.float64):
+	def core_terms():
+		for (offset, start, stop, chunk) in iter_chunks(sig, rate, chunk_size, overlap, lowpass, float_dtype):
+			(chunk_rate, chunk) = resample(chunk, rate, target_rate, float_dtype)
+			if len(chunk) < 4:
+				continue
+			(rho_0, Gamma_mu_0, Gamma_rho_kappa) = ACC_terms(chunk, chunk_rate, float_dtype)
+			lo = int(round((start - offset) * chunk_rate / float(rate)))
+			hi = int(round((stop - offset) * chunk_rate / float(rate)))
+			# Gamma_rho_kappa[j] belongs to sample j+1 of the window
+			yield (np.log(rho_0), Gamma_mu_0[lo:hi], np.log(Gamma_rho_kappa[max(lo-1, 0):max(hi-1, 0)]))
+	Gamma_sum, Gamma_n, log_sum, log_n, log_rho = 0.0, 0, 0.0, 0, None
+	for (log_rho, Gamma_mu_0, log_Gamma) in core_terms():
+		Gamma_sum += np.sum(Gamma_mu_0, dtype=np.float64)
+		Gamma_n += len(Gamma_mu_0)
+		log_sum += np.sum(log_Gamma, dtype=np.float64)
+		log_n += len(log_Gamma)
+	if not log_n:
+		return None
+	temp = Gamma_sum / Gamma_n
+	h_bar = (log_sum / log_n - np.log(temp)) / float(log_rho)
+	ACC_max, running = -np.inf, 0.0
+	for (_, _, log_Gamma) in core_terms():
+		if len(log_Gamma) == 0:
+			continue
+		ACC = running + np.cumsum((log_Gamma - np.log(temp)) / float(log_rho) - h_bar, dtype=np.float64)
+		ACC_max = max(ACC_max, ACC.max())
+		running = ACC[-1]
+	return (temp, h_bar, ACC_max)
+
+# One boundary detection pass (raw or low-pass) over a whole file, returns
+# the sampling rate and the boundaries as sample indices. Boundaries already
+# found for the same audio and settings are read from the feature cache.
+def boundary_pass(filename, lowpass, epsilon, chunk_seconds=None, overlap_seconds=0.5, refine=False, target_rate=None, cache=None, float_dtype=np.float64):
+	(rate,sig) = read_signal(filename)
+	args = (sig, rate, lowpass, epsilon, chunk_seconds, overlap_seconds, refine, target_rate, float_dtype)
+	# boundaries are looked up in the shared feature cache unless cache is False
+	if cache is None:
+		cache = get_cache()
+	if cache:
+		params = {'version': BOUNDARIES_VERSION, 'lowpass': lowpass, 'epsilon': epsilon, 'chunk_seconds': chunk_seconds,
+			'overlap_seconds': overlap_seconds, 'refine': refine, 'target_rate': target_rate,
+			'float_dtype': np.dtype(float_dtype).name}
+		bounds = cache.get_or_compute(filename, 'khanaga_bounds', params,
+			lambda: np.array(find_boundaries(*args), dtype=np.int64))
+		return (rate,[int(b) for b in bounds])
+	return (rate,find_boundaries(*args))
+
+# Boundaries (sample indices) of one pass over sig. Boundaries found in the
+# overlap of a window belong to the neighbouring window's core and are
+# dropped, so chunk seams produce no duplicates. With target_rate set, every
+# window is decimated to that rate before ACC is computed; boundaries are
+# still reported in samples of the original rate. float_dtype=np.float32 runs
+# filtering, resampling and ACC in single precision.
+def find_boundaries(sig, rate, lowpass, epsilon, chunk_seconds=None, overlap_seconds=0.5, refine=False, target_rate=None, float_dtype=np.float64):
+	if chunk_seconds is None:
+		chunk_size, overlap = max(len(sig), 1), 0
+	else:
+		chunk_size = max(int(chunk_seconds * rate), 1)
+		overlap = int(overlap_seconds * rate)
+	# every window is normalised with the statistics of the whole signal
+	stats = None if chunk_seconds is None else ACC_stats(sig, rate, chunk_size, overlap, lowpass, target_rate, float_dtype)
+	bounds = []
+	for (offset, start, stop, chunk) in iter_chunks(sig, rate, chunk_size, overlap, lowpass, float_dtype):
+		(chunk_rate, chunk) = resample(chunk, rate, target_rate, float_dtype)
+		# compute_ACC needs at least four samples
+		if len(chunk) < 4:
+			continue
+		(SE,ACC) = compute_ACC(chunk,chunk_rate,float_dtype,stats)
+		chunk_bounds = PLA(ACC, epsilon)
+		if refine:
+			# Refine Boundaries with LLRT
+			chunk_bounds = refineBoundaries(chunk_bounds, SE, min_length=int(REFINE_MIN_SEGMENT_SECONDS * chunk_rate))
+		chunk_bounds = [offset + int(round(c * rate / float(chunk_rate))) for c in chunk_bounds]
+		bounds += [c for c in chunk_bounds if start <= c < stop]
+	return bounds
+
+# Phone boundaries (in seconds) found on the raw and low-pass filtered signal.
+# With chunk_seconds set, the file is processed in overlapping windows of that
+# length so memory use does not grow with the length of the recording (ACC
+# is still normalised over the whole file, which costs two more reads of
+# it). With parallel set, the raw and low-pass passes run in two separate
+# processes. With refine set, each pass drops the boundaries that fail the
+# LLRT on its own ACC input (fewer spurious boundaries for a little extra
+# CPU). With target_rate set, the signal is decimated to that rate (e.g.
+# 16000) before ACC is computed.
+# cache=False skips the feature cache. float_dtype=np.float32 keeps the signal
+# processing in single precision (half the memory traffic; boundaries can
+# move by a few samples).
+def get_results(filename, chunk_seconds=None, overlap_seconds=0.5, parallel=False, refine=False, target_rate=None, cache=None, float_dtype=np.float64):
 	# Find possible boundaries with PLA
 	epsilon = 0.0001
-	bounds1 = PLA(ACC1, epsilon)
-	bounds2 = PLA(ACC2, epsilon)
+	passes = [(filename, False, epsilon, chunk_seconds, overlap_seconds, refine, target_rate, cache, float_dtype),
+		(filename, True, epsilon, chunk_seconds, overlap_seconds, refine, target_rate, cache, float_dtype)]
+	if parallel:
+		with ProcessPoolExecutor(max_workers=2) as executor:
+			((rate,bounds1), (_,bounds2)) = executor.map(boundary_pass, *zip(*passes))
+	else:
+		((rate,bounds1), (_,bounds2)) = [boundary_pass(*args) for args in passes]
 
 	# Tolerance for boundary detection
 	tolerance = 10 #ms
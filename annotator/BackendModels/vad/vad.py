@@ -1,72 +1,117 @@
 import numpy as np
-import scipy.io.wavfile as wf
+from ..audio import mix_to_mono, read_wav, resample
+from ..feature_cache import get_cache
 
-class VoiceActivityDetector():
-    """ Use signal energy to detect voice activity in wav file """
-    
-    def __init__(self, wave_input_filename, window=0.5, threshold=0.3):
-        self._read_wav(wave_input_filename)._convert_to_mono()
-        self.sample_window = 0.02 #20 ms
-        self.sample_overlap = 0.01 #10ms
+# Part of the feature cache key of the speech ratios; bump it whenever a
+# change to their computation changes its output
+SPEECH_RATIOS_VERSION = 1
+
+class SpeechEnergyDetector():
+    """ What VoiceActivityDetector and StreamingVoiceActivityDetector share:
+    the analysis windows, the speech band and the speech band energy ratio
+    of a window. Subclasses set self.rate.
+    """
+    sample_window = 0.02 #20 ms
+    sample_overlap = 0.01 #10ms
+    speech_start_band = 300
+    speech_end_band = 3000
+
+    def __init__(self, window=0.5, threshold=0.3, float_dtype=np.float64):
+        # np.float32 runs resampling and the spectra in single precision
+        self.float_dtype = np.dtype(float_dtype)
         self.speech_window = window #half a second
         self.speech_energy_threshold = threshold #30% of energy in voice band
-        self.speech_start_band = 300
-        self.speech_end_band = 3000
+
+    def _speech_band_mask(self, sample_window):
+        """ Boolean mask over the rfft bins of one window that selects the
+        speech band, plus a mask of all bins except DC.
+        """
+        data_freq = np.fft.rfftfreq(sample_window, 1.0/self.rate)
+        full_band = data_freq > 0
+        speech_band = (data_freq > self.speech_start_band) & (data_freq < self.speech_end_band)
+        return speech_band, full_band
+
+    def _window_speech_ratios(self, frames, speech_band, full_band):
+        """ Speech band to total energy ratio of each row of frames. """
+        data_energy = np.abs(np.fft.rfft(frames, axis=1)) ** 2
+        sum_voice_energy = data_energy[:, speech_band].sum(axis=1)
+        sum_full_energy = data_energy[:, full_band].sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return sum_voice_energy / sum_full_energy
+
+    def _median_window(self, speech_window=None):
+        if speech_window is None: speech_window = self.speech_window
+        median_window=int(speech_window/self.sample_window)
+        if median_window%2==0: median_window=median_window-1
+        return median_window
+
+
+class VoiceActivityDetector(SpeechEnergyDetector):
+    """ Use signal energy to detect voice activity in wav file """
+    
+    def __init__(self, wave_input_filename, window=0.5, threshold=0.3, target_rate=None, cache=None, float_dtype=np.float64):
+        super().__init__(window, threshold, float_dtype)
+        self._read_wav(wave_input_filename)._resample(target_rate)
+        self.target_rate = target_rate
+        # speech ratios are looked up in the shared feature cache unless cache is False
+        self.cache = get_cache() if cache is None else cache
            
     def _read_wav(self, wave_file):
-        self.rate, self.data = wf.read(wave_file)
+        # self.data stays memory-mapped in the file's dtype; stereo audio is
+        # mixed down one batch of windows at a time in _calculate_speech_ratios
+        self.rate, self.data = read_wav(wave_file)
         self.channels = len(self.data.shape)
         self.filename = wave_file
         return self
     
-    def _convert_to_mono(self):
-        if self.channels == 2 :
-            self.data = np.mean(self.data, axis=1, dtype=self.data.dtype)
+    def _resample(self, target_rate):
+        if target_rate and target_rate < self.rate:
+            self.rate, self.data = resample(mix_to_mono(self.data, self.float_dtype), self.rate, target_rate, self.float_dtype)
             self.channels = 1
         return self
-    
-    def _calculate_frequencies(self, audio_data):
-        data_freq = np.fft.fftfreq(len(audio_data),1.0/self.rate)
-        data_freq = data_freq[1:]
-        return data_freq    
-    
-    def _calculate_amplitude(self, audio_data):
-        data_ampl = np.abs(np.fft.fft(audio_data))
-        data_ampl = data_ampl[1:]
-        return data_ampl
-        
-    def _calculate_energy(self, data):
-        data_amplitude = self._calculate_amplitude(data)
-        data_energy = data_amplitude ** 2
-        return data_energy
-        
-    def _znormalize_energy(self, data_energy):
-        energy_mean = np.mean(data_energy)
-        energy_std = np.std(data_energy)
-        energy_znorm = (data_energy - energy_mean) / energy_std
-        return energy_znorm
-    
-    def _connect_energy_with_frequencies(self, data_freq, data_energy):
-        energy_freq = {}
-        for (i, freq) in enumerate(data_freq):
-            if abs(freq) not in energy_freq:
-                energy_freq[abs(freq)] = data_energy[i] * 2
-        return energy_freq
-    
-    def _calculate_normalized_energy(self, data):
-        data_freq = self._calculate_frequencies(data)
-        data_energy = self._calculate_energy(data)
-        #data_energy = self._znormalize_energy(data_energy) #znorm brings worse results
-        energy_freq = self._connect_energy_with_frequencies(data_freq, data_energy)
-        return energy_freq
-    
-    def _sum_energy_in_band(self,energy_frequencies, start_band, end_band):
-        sum_energy = 0
-        for f in energy_frequencies.keys():
-            if start_band<f<end_band:
-                sum_energy += energy_frequencies[f]
-        return sum_energy
-    
+
+    def _calculate_speech_ratios(self, batch_size=4096):
+        """ Ratio between speech band energy and total energy of every analysis
+        window, from the feature cache when this file was analysed before.
+        Output is (array of window start samples, array of ratios).
+        """
+        if not self.cache:
+            return self._compute_speech_ratios(batch_size)
+        params = {'version': SPEECH_RATIOS_VERSION, 'rate': self.rate, 'target_rate': self.target_rate,
+                  'sample_window': self.sample_window, 'sample_overlap': self.sample_overlap,
+                  'speech_band': [self.speech_start_band, self.speech_end_band],
+                  'float_dtype': self.float_dtype.name}
+        ratios = self.cache.get_or_compute(self.filename, 'vad_speech_ratios', params,
+                                           lambda: self._compute_speech_ratios(batch_size)[1])
+        sample_starts = np.arange(len(ratios)) * int(self.rate * self.sample_overlap)
+        return sample_starts, ratios
+
+    def _compute_speech_ratios(self, batch_size=4096):
+        """ Windows are strided views into the signal and their spectra come
+        from one rfft per batch of batch_size windows.
+        """
+        sample_window = int(self.rate * self.sample_window)
+        sample_overlap = int(self.rate * self.sample_overlap)
+        data = self.data
+        num_windows = 0
+        if len(data) > sample_window:
+            num_windows = (len(data) - sample_window - 1) // sample_overlap + 1
+        sample_starts = np.arange(num_windows) * sample_overlap
+        speech_band, full_band = self._speech_band_mask(sample_window)
+        ratios = np.zeros(num_windows, dtype=self.float_dtype)
+        if num_windows == 0:
+            return sample_starts, ratios
+        for start in range(0, num_windows, batch_size):
+            stop = min(start + batch_size, num_windows)
+            # only this batch's samples are read from the file and mixed down
+            block = np.ascontiguousarray(mix_to_mono(data[start * sample_overlap:(stop - 1) * sample_overlap + sample_window], self.float_dtype),
+                                         dtype=self.float_dtype)
+            batch = np.lib.stride_tricks.as_strided(block, shape=(stop - start, sample_window),
+                                                    strides=(block.strides[0] * sample_overlap, block.strides[0]),
+                                                    writeable=False)
+            ratios[start:stop] = self._window_speech_ratios(batch, speech_band, full_band)
+        return sample_starts, ratios
+
     def _median_filter (self, x, k):
         assert k % 2 == 1, "Median filter length must be odd."
         assert x.ndim == 1, "Input must be one-dimensional."
@@ -81,9 +126,8 @@ class VoiceActivityDetector():
             y[-j:,-(i+1)] = x[-1]
         return np.median (y, axis=1)
         
-    def _smooth_speech_detection(self, detected_windows):
-        median_window=int(self.speech_window/self.sample_window)
-        if median_window%2==0: median_window=median_window-1
+    def _smooth_speech_detection(self, detected_windows, speech_window=None):
+        median_window = self._median_window(speech_window)
         median_energy = self._median_filter(detected_windows[:,1], median_window)
         return median_energy
         
@@ -133,26 +177,137 @@ class VoiceActivityDetector():
         and total energy.
         Output is array of window numbers and speech flags (1 - speech, 0 - nonspeech).
         """
-        detected_windows = np.array([])
-        sample_window = int(self.rate * self.sample_window)
-        sample_overlap = int(self.rate * self.sample_overlap)
-        data = self.data
-        sample_start = 0
-        start_band = self.speech_start_band
-        end_band = self.speech_end_band
-        while (sample_start < (len(data) - sample_window)):
-            sample_end = sample_start + sample_window
-            if sample_end>=len(data): sample_end = len(data)-1
-            data_window = data[sample_start:sample_end]
-            energy_freq = self._calculate_normalized_energy(data_window)
-            sum_voice_energy = self._sum_energy_in_band(energy_freq, start_band, end_band)
-            sum_full_energy = sum(energy_freq.values())
-            speech_ratio = sum_voice_energy/sum_full_energy
-            # Hipothesis is that when there is a speech sequence we have ratio of energies more than Threshold
-            speech_ratio = speech_ratio>self.speech_energy_threshold
-            detected_windows = np.append(detected_windows,[sample_start, speech_ratio])
-            sample_start += sample_overlap
-        detected_windows = detected_windows.reshape(int(len(detected_windows)/2),2)
-        detected_windows[:,1] = self._smooth_speech_detection(detected_windows)
+        sample_starts, speech_ratios = self._calculate_speech_ratios()
+        return self._detect_from_ratios(sample_starts, speech_ratios, self.speech_energy_threshold, self.speech_window)
+
+    def _detect_from_ratios(self, sample_starts, speech_ratios, threshold, speech_window):
+        # Hipothesis is that when there is a speech sequence we have ratio of energies more than Threshold
+        detected_windows = np.zeros((len(sample_starts), 2))
+        detected_windows[:,0] = sample_starts
+        detected_windows[:,1] = speech_ratios > threshold
+        detected_windows[:,1] = self._smooth_speech_detection(detected_windows, speech_window)
         return detected_windows
- 
+
+    def sweep(self, thresholds, windows):
+        """ Speech detection for every combination of energy threshold and
+        smoothing window (in seconds). The speech band energy ratios are
+        computed once and reused, so only thresholding and smoothing are
+        repeated for each setting.
+        Output is a dict mapping (threshold, window) to the speech intervals
+        that convert_windows_to_readible_labels gives for that setting.
+        """
+        sample_starts, speech_ratios = self._calculate_speech_ratios()
+        speech_labels = {}
+        for threshold in thresholds:
+            for window in windows:
+                detected_windows = self._detect_from_ratios(sample_starts, speech_ratios, threshold, window)
+                speech_labels[(threshold, window)] = self.convert_windows_to_readible_labels(detected_windows)
+        return speech_labels
+
+
+class StreamingVoiceActivityDetector(SpeechEnergyDetector):
+    """ Same detector as VoiceActivityDetector, fed with PCM chunks as they
+    arrive instead of a whole wav file. Only the samples of the next analysis
+    window and the flags still inside the median filter are kept, and speech
+    spans are returned as soon as no later sample can change them.
+    Fed with the samples of a file, it reports exactly the spans that
+    convert_windows_to_readible_labels(detect_speech()) reports for it.
+    """
+
+    def __init__(self, rate, window=0.5, threshold=0.3, dtype=np.int16, channels=1, float_dtype=np.float64):
+        super().__init__(window, threshold, float_dtype)
+        self.rate = rate
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        self._window_samples = int(self.rate * self.sample_window)
+        self._step = int(self.rate * self.sample_overlap)
+        self._speech_band, self._full_band = self._speech_band_mask(self._window_samples)
+        self._half_median = (self._median_window() - 1) // 2
+        self._pending_bytes = b''
+        # samples from the start of the next window onwards
+        self._buffer = np.zeros(0, dtype=self.float_dtype)
+        self._next_window = 0
+        # speech flags of windows _flags_start.. that the median filter still needs
+        self._flags = np.zeros(0, dtype=bool)
+        self._flags_start = 0
+        self._next_output = 0
+        self._is_speech = False
+        self._speech_begin = None
+
+    def _to_mono(self, chunk):
+        if isinstance(chunk, (bytes, bytearray, memoryview)):
+            chunk = self._pending_bytes + bytes(chunk)
+            frame_size = self.dtype.itemsize * self.channels
+            usable = len(chunk) - len(chunk) % frame_size
+            self._pending_bytes = chunk[usable:]
+            chunk = np.frombuffer(chunk[:usable], dtype=self.dtype)
+            if self.channels > 1:
+                chunk = chunk.reshape(-1, self.channels)
+        return mix_to_mono(np.asarray(chunk), self.float_dtype)
+
+    def process(self, chunk):
+        """ Feeds the next chunk of PCM samples, either an array (samples or
+        samples x channels) or raw bytes in dtype/channels layout.
+        Output is the list of speech intervals that became final.
+        """
+        samples = self._to_mono(chunk)
+        self._buffer = np.concatenate((self._buffer, np.asarray(samples, dtype=self.float_dtype)))
+        # As in detect_speech, a window is only analysed once at least one
+        # sample after it has arrived
+        num_windows = 0
+        if len(self._buffer) > self._window_samples:
+            num_windows = (len(self._buffer) - self._window_samples - 1) // self._step + 1
+        if num_windows > 0:
+            frames = np.lib.stride_tricks.as_strided(self._buffer, shape=(num_windows, self._window_samples),
+                                                     strides=(self._buffer.strides[0] * self._step, self._buffer.strides[0]),
+                                                     writeable=False)
+            ratios = self._window_speech_ratios(frames, self._speech_band, self._full_band)
+            self._flags = np.concatenate((self._flags, ratios > self.speech_energy_threshold))
+            self._next_window += num_windows * self._step
+            self._buffer = self._buffer[num_windows * self._step:].copy()
+        return self._smooth(final=False)
+
+    def flush(self):
+        """ Ends the stream. Output is the list of the remaining speech
+        intervals; like convert_windows_to_readible_labels, a speech interval
+        still open at the end of the stream is not reported.
+        """
+        return self._smooth(final=True)
+
+    def detect(self, chunks):
+        """ Runs the detector over an iterable of PCM chunks and yields speech
+        intervals as they become final.
+        """
+        for chunk in chunks:
+            for speech_label in self.process(chunk):
+                yield speech_label
+        for speech_label in self.flush():
+            yield speech_label
+
+    def _smooth(self, final):
+        k2 = self._half_median
+        num_flags = self._flags_start + len(self._flags)
+        # The median of a window needs the flags k2 windows ahead, except at
+        # the end of the stream where the last flag is repeated instead
+        stop = num_flags if final else num_flags - k2
+        if stop <= self._next_output:
+            return []
+        index = np.clip(np.arange(self._next_output - k2, stop + k2), 0, num_flags - 1)
+        flags = self._flags[index - self._flags_start]
+        # median of 0/1 flags over an odd window is a majority vote
+        counts = np.concatenate(([0], np.cumsum(flags)))
+        smoothed = (counts[2*k2+1:] - counts[:-(2*k2+1)]) > k2
+        speech_time = []
+        previous = np.concatenate(([self._is_speech], smoothed[:-1]))
+        for i in np.flatnonzero(smoothed != previous):
+            window_start = (self._next_output + i) * self._step
+            if smoothed[i]:
+                self._speech_begin = window_start / self.rate
+            else:
+                speech_time.append({'speech_begin': self._speech_begin, 'speech_end': window_start / self.rate})
+        self._is_speech = bool(smoothed[-1])
+        self._next_output = stop
+        keep_from = max(self._next_output - k2, 0)
+        self._flags = self._flags[keep_from - self._flags_start:]
+        self._flags_start = keep_from
+        return speech_time
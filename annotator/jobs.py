@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+
+from annotator.BackendModels import clips
+from annotator.BackendModels import feature_cache
+
+# Progress reporting of the RQ jobs that job_status can follow: while a job
+# runs, job.meta["progress"] says how far it got ({"done", "total", ...})
+# and job.meta["results"] holds the results finished so far. Such jobs are
+# enqueued with meta=owner_meta(user name), and job_status only reports
+# them to that user.
+
+
+def owner_meta(owner):
+    return {"owner": owner}
+
+
+def is_owner(job, owner):
+    return bool(owner) and job.meta.get("owner") == owner
+
+
+def error_summary(exc_info):
+    """ The last line of a failed job's traceback ("ValueError: ..."), which
+    says what went wrong without showing the server's code and paths.
+    """
+    lines = [line for line in (exc_info or "").splitlines() if line.strip()]
+    return lines[-1].strip() if lines else "failed"
+
+
+def progress_reporter(job, **extra):
+    """ A progress(results, total) callback that records both in job.meta,
+    along with extra (e.g. which file of a batch is being processed).
+    """
+    def progress(results, total):
+        job.meta["progress"] = dict({"done": len(results), "total": total}, **extra)
+        job.meta["results"] = results
+        job.save_meta()
+    return progress
+
+
+def job_status_data(job):
+    """ What job_status reports for a job: its status, progress, results
+    (partial while it runs, all of them once it has finished) and, if it
+    failed, the error (see error_summary).
+    """
+    response_data = {
+        "job_id": job.id,
+        "status": job.get_status(),
+        "progress": job.meta.get("progress"),
+        "results": job.result if job.is_finished else job.meta.get("results", []),
+    }
+    if job.is_failed:
+        response_data["error"] = error_summary(job.exc_info)
+    return response_data
+
+
+def transcribe_cached_audio(job, plugin, digests, segments, params, cache=None):
+    """ Body of phone_transcription_job: transcribes the segments of every
+    audio (by SHA-256, from the audio cache) with plugin, reporting progress
+    per file. Output is the transcription of the last file, as in the
+    synchronous phone_transcription.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix="allosaurus-elan-")
+    response_data = []
+    try:
+        for (i, digest) in enumerate(digests):
+            decoded = feature_cache.decoded_audio(digest, cache)
+            if decoded is None:
+                raise ValueError(f"audio {digest} is no longer cached on the server, please upload it again")
+            (rate, samples) = decoded
+            progress = progress_reporter(job, file=i + 1, files=len(digests))
+            # an RQ work horse ends with os._exit, which would orphan a pool kept for the process
+            response_data = clips.transcribe(plugin, rate, samples, segments, params, tmp_dir=tmp_dir,
+                                             progress=progress, keep_workers=False)
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+    return response_data
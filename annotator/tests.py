@@ -1,3 +1,1095 @@
-from django.test import TestCase
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock, skipUnless
+
+import numpy as np
+import scipy.io.wavfile as wav
+from django.apps import apps
+from django.test import SimpleTestCase, TestCase
+
+from annotator import jobs
+from annotator import uploads
+from annotator.BackendModels import audio
+from annotator.BackendModels import clips
+from annotator.BackendModels import diarization
+from annotator.BackendModels import feature_cache
+from annotator.BackendModels import finetune_data
+from annotator.BackendModels.khanaga import khanaga
+from annotator.BackendModels.khanaga import features
+from annotator.BackendModels.khanaga.features import sigproc
+from annotator.BackendModels.vad import vad
+
+
+def reference_compute_ACC(sig, rate):
+    """Original per-sample loop implementation of khanaga.compute_ACC, kept for equivalence tests."""
+    Gamma_mu_0 = np.zeros([len(sig)])
+    Gamma_mu_1 = np.zeros([len(sig)])
+    kappa_tau = np.zeros([len(sig)])
+    rho_0 = 1.0/rate
+    for n in range(1,len(sig)):
+        Gamma_mu_0[n] = np.abs(sig[n]-sig[n-1])
+        if (Gamma_mu_0[n] == 0):
+            Gamma_mu_0[n] = 0.0001
+    for n in range(1,len(sig)-1):
+        Gamma_mu_1[n] = np.abs(sig[n]-sig[n-1]) + np.abs(sig[n+1] - sig[n])
+        if (Gamma_mu_1[n] == 0):
+            Gamma_mu_1[n] = 0.0001
+    for n in range(1,len(sig)-1):
+        kappa_tau[n] = np.sqrt(np.divide(Gamma_mu_1[n],Gamma_mu_0[n]))
+        if (kappa_tau[n] == 0):
+            kappa_tau[n] = 0.0001
+    Gamma_rho_kappa = np.multiply(kappa_tau,Gamma_mu_0)
+    Gamma_rho_kappa = Gamma_rho_kappa[1:len(sig)-1]
+    temp = np.average(Gamma_mu_0)
+    h = (np.log(Gamma_rho_kappa) - np.log(temp)) / np.log(rho_0)
+    h_help = h - np.average(h)
+    ACC = np.zeros([len(h)-1])
+    for n in range(1,len(h)):
+        ACC[n-1] = np.sum(h_help[:n])
+    ACC = ACC / np.max(ACC)
+    return (h,ACC)
+
+
+def reference_PLA(ACC, epsilon):
+    """Original PLA loop, calling khanaga.MSE on fresh slices for every window."""
+    N = len(ACC)
+    i = 1
+    c = [1]
+    k1 = 3
+    while (k1 < N):
+        if (khanaga.MSE(ACC[c[i-1]:k1], c[i-1], k1) > epsilon):
+            l = k1 - c[i-1]
+            E2 = np.empty([l])
+            for k2 in range(l):
+                E2[k2] = khanaga.MSE(ACC[c[i-1]:c[i-1]+k2], c[i-1], c[i-1]+k2) + khanaga.MSE(ACC[c[i-1]+k2:k1], c[i-1]+k2, k1)
+            ci = np.argmin(E2) + c[i-1]
+            c.append(ci)
+            k1 = c[i]
+            i += 1
+        k1 += 1
+    return c
+
+
+def synthetic_clip(rate=16000, seconds=0.1, seed=0):
+    """Short int16 clip: a few tones separated by silence, plus a little noise."""
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(rate * seconds)) / float(rate)
+    sig = np.zeros(len(t))
+    for i, freq in enumerate([220.0, 880.0, 440.0]):
+        part = slice(i * len(t) // 3, (i + 1) * len(t) // 3 - len(t) // 12)
+        sig[part] = 8000 * np.sin(2 * np.pi * freq * t[part])
+    sig += rng.normal(0, 50, len(t))
+    return np.round(sig).astype(np.int16)
+
+
+class KhanagaACCTests(SimpleTestCase):
+
+    def test_matches_reference_on_int16_clip(self):
+        rate = 16000
+        sig = synthetic_clip(rate)
+        h, ACC = khanaga.compute_ACC(sig, rate)
+        h_ref, ACC_ref = reference_compute_ACC(sig.astype(np.float64), rate)
+        np.testing.assert_allclose(h, h_ref, rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(ACC, ACC_ref, rtol=1e-9, atol=1e-9)
+
+    def test_matches_reference_with_flat_regions(self):
+        # Repeated samples exercise the 0.0001 floor on both difference terms
+        rate = 8000
+        sig = np.repeat(synthetic_clip(rate, seconds=0.05, seed=1), 3)[:600]
+        sig[100:200] = 0
+        h, ACC = khanaga.compute_ACC(sig, rate)
+        h_ref, ACC_ref = reference_compute_ACC(sig.astype(np.float64), rate)
+        np.testing.assert_allclose(h, h_ref, rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(ACC, ACC_ref, rtol=1e-9, atol=1e-9)
+
+    def test_output_shapes(self):
+        sig = synthetic_clip(seconds=0.01)
+        h, ACC = khanaga.compute_ACC(sig, 16000)
+        self.assertEqual(len(h), len(sig) - 2)
+        self.assertEqual(len(ACC), len(sig) - 3)
+
+
+class KhanagaPLATests(SimpleTestCase):
+
+    def test_segment_MSE_matches_MSE(self):
+        _, ACC = khanaga.compute_ACC(synthetic_clip(seconds=0.02), 16000)
+        sums = khanaga.segment_sums(ACC, 5, 200)
+        for x1, x2 in [(0, 0), (0, 1), (0, 2), (3, 50), (17, 195), (194, 195)]:
+            expected = khanaga.MSE(ACC[5+x1:5+x2], 5+x1, 5+x2)
+            self.assertAlmostEqual(float(khanaga.segment_MSE(sums, x1, x2)), expected, places=12)
+
+    def test_same_boundaries_as_reference(self):
+        rate = 16000
+        sig = synthetic_clip(rate, seconds=0.2)
+        for s in (sig, khanaga.butter_lowpass_filter(sig, 1800, rate, 6)):
+            _, ACC = khanaga.compute_ACC(s, rate)
+            for epsilon in (0.0001, 0.00001):
+                self.assertEqual(khanaga.PLA(ACC, epsilon), reference_PLA(ACC, epsilon))
+                # a short look-ahead must not change the result
+                self.assertEqual(khanaga.PLA(ACC, epsilon, horizon=16), reference_PLA(ACC, epsilon))
+
+
+class KhanagaChunkedTests(SimpleTestCase):
+
+    def setUp(self):
+        self.rate = 16000
+        self.sig = np.concatenate([synthetic_clip(self.rate, seconds=0.25, seed=seed) for seed in range(4)])
+        fd, self.filename = tempfile.mkstemp(suffix='.wav')
+        os.close(fd)
+        wav.write(self.filename, self.rate, self.sig)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_unchunked_matches_whole_signal(self):
+        _, ACC1 = khanaga.compute_ACC(self.sig, self.rate)
+        _, ACC2 = khanaga.compute_ACC(khanaga.butter_lowpass_filter(self.sig, 1800, self.rate, 6), self.rate)
+        expected = sorted(set(khanaga.PLA(ACC1, 0.0001) + khanaga.PLA(ACC2, 0.0001)))
+        self.assertEqual(khanaga.get_results(self.filename, cache=False), [b / float(self.rate) for b in expected])
+
+    def test_lowpass_chunks_match_whole_signal_filter(self):
+        lowsig = khanaga.butter_lowpass_filter(self.sig, 1800, self.rate, 6)
+        for (offset, start, stop, chunk) in khanaga.iter_chunks(self.sig, self.rate, 3000, 500, lowpass=True):
+            self.assertLessEqual(offset, start)
+            np.testing.assert_allclose(chunk, lowsig[offset:offset+len(chunk)], atol=1e-6)
+
+    def test_window_stats_match_whole_signal(self):
+        rho_0, Gamma_mu_0, Gamma_rho_kappa = khanaga.ACC_terms(self.sig, self.rate)
+        h = (np.log(Gamma_rho_kappa) - np.log(np.average(Gamma_mu_0))) / np.log(rho_0)
+        ACC = np.cumsum(h - np.average(h))
+        stats = khanaga.ACC_stats(self.sig, self.rate, 3000, 500)
+        np.testing.assert_allclose(stats, (np.average(Gamma_mu_0), np.average(h), np.max(ACC)), rtol=1e-3)
+
+    def test_chunked_boundaries_match_unchunked(self):
+        unchunked = khanaga.get_results(self.filename, cache=False)
+        for (chunk_seconds, overlap_seconds) in ((0.5, 0.1), (0.2, 0.05)):
+            output = khanaga.get_results(self.filename, chunk_seconds=chunk_seconds, overlap_seconds=overlap_seconds, cache=False)
+            self.assertEqual(output, sorted(set(output)))
+            HR, OS, FA = khanaga.partial(output, unchunked, 1, 1000)
+            self.assertGreaterEqual(khanaga.F1(HR, FA), 0.95)
+            self.assertLessEqual(abs(OS), 0.05)
+
+
+class KhanagaRefineTests(SimpleTestCase):
+
+    def test_llrt_matches_direct_moments(self):
+        rng = np.random.RandomState(0)
+        SE = np.concatenate([rng.normal(0, 1, 300), rng.normal(2, 0.5, 200)])
+        S1 = np.concatenate(([0.0], np.cumsum(SE)))
+        S2 = np.concatenate(([0.0], np.cumsum(SE ** 2)))
+        c = [0, 120, 300, 410, 500]
+        def loglik(x):
+            return -0.5 * len(x) * np.log(np.var(x))
+        expected = [loglik(SE[c[i-1]:c[i]]) + loglik(SE[c[i]:c[i+1]]) - loglik(SE[c[i-1]:c[i+1]]) for i in range(1, len(c)-1)]
+        np.testing.assert_allclose(khanaga.LLRT(S1, S2, c), expected, rtol=1e-8)
+
+    def test_refine_keeps_real_change_and_drops_spurious_ones(self):
+        rng = np.random.RandomState(1)
+        SE = np.concatenate([rng.normal(0, 1, 1000), rng.normal(3, 1, 1000)])
+        refined = khanaga.refineBoundaries([0, 250, 500, 1000, 1300, 1700, 2000], SE)
+        self.assertEqual(refined, [0, 1000, 2000])
+
+    def test_refine_drops_near_adjacent_boundaries(self):
+        rng = np.random.RandomState(2)
+        SE = rng.normal(0, 1, 2000)
+        self.assertEqual(khanaga.refineBoundaries([0, 500, 501, 502, 1000, 1003, 2000], SE), [0, 2000])
+        SE = np.concatenate([rng.normal(0, 1, 1000), rng.normal(3, 1, 1000)])
+        self.assertEqual(khanaga.refineBoundaries([0, 999, 1000, 1001, 2000], SE), [0, 1000, 2000])
+
+
+def reference_partial(bounds, gold, tolerance, rate):
+    """Original nested-loop scorer (without the per-hit print)."""
+    NR = float(len(gold))
+    NT = float(len(bounds))
+    window = tolerance * rate / 1000.0
+    NH = 0.0
+    gold2 = list(gold)
+    for b in bounds:
+        for g in gold2[:]:
+            if (np.abs(g-b) < window):
+                gold2.remove(g)
+                NH += 1.0
+                break
+    return (NH / NR, (NT - NR) / NR, (NT - NH) / NT)
+
+
+class KhanagaEvaluationTests(SimpleTestCase):
+
+    def random_boundaries(self, rng, n, length):
+        return sorted(rng.randint(0, length, size=n).tolist())
+
+    def test_partial_matches_reference(self):
+        rng = np.random.RandomState(0)
+        for _ in range(20):
+            gold = self.random_boundaries(rng, 30, 16000)
+            bounds = self.random_boundaries(rng, 45, 16000)
+            for tolerance in (5, 10, 20):
+                self.assertEqual(khanaga.partial(bounds, gold, tolerance, 16000),
+                                 reference_partial(bounds, gold, tolerance, 16000))
+
+    def test_batch_partial_pools_files(self):
+        rng = np.random.RandomState(1)
+        gold_list = [self.random_boundaries(rng, 20, 8000) for _ in range(5)]
+        bounds_list = [self.random_boundaries(rng, 25, 8000) for _ in range(5)]
+        scores = khanaga.batch_partial(bounds_list, gold_list, [10, 20], 8000)
+        self.assertEqual(scores.shape, (2, 4))
+        for (row, tolerance) in zip(scores, (10, 20)):
+            NH = sum(khanaga.count_hits(b, g, tolerance * 8.0) for (b, g) in zip(bounds_list, gold_list))
+            HR = NH / 100.0
+            FA = (125.0 - NH) / 125.0
+            np.testing.assert_allclose(row, [HR, 0.25, FA, khanaga.F1(HR, FA)])
+
+
+class ResampleTests(SimpleTestCase):
+
+    def test_decimation_keeps_passband_and_removes_aliases(self):
+        rate = 48000
+        t = np.arange(rate) / float(rate)
+        low = np.sin(2 * np.pi * 1000 * t)
+        high = np.sin(2 * np.pi * 11000 * t)  # would alias to 5000 Hz at 16 kHz
+        new_rate, sig = audio.resample(low + high, rate, 16000)
+        self.assertEqual(new_rate, 16000)
+        self.assertEqual(len(sig), 16000)
+        spectrum = np.abs(np.fft.rfft(sig[1000:-1000]))
+        freqs = np.fft.rfftfreq(len(sig) - 2000, 1.0 / new_rate)
+        self.assertGreater(spectrum[np.argmin(np.abs(freqs - 1000))], 100 * spectrum[np.argmin(np.abs(freqs - 5000))])
+
+    def test_no_upsampling(self):
+        sig = np.arange(10, dtype=np.int16)
+        self.assertIs(audio.resample(sig, 8000, 16000)[1], sig)
+        self.assertIs(audio.resample(sig, 8000, None)[1], sig)
+
+
+class DecodeTests(SimpleTestCase):
+
+    def test_read_pcm_stream(self):
+        samples = synthetic_clip(16000, seconds=0.5)
+        data = samples.astype('<i2').tobytes()
+        in_memory = audio.read_pcm_stream(io.BytesIO(data))
+        np.testing.assert_array_equal(in_memory, samples)
+        self.assertNotIsInstance(in_memory, np.memmap)
+        spilled = audio.read_pcm_stream(io.BytesIO(data), memmap_bytes=1000)
+        self.assertIsInstance(spilled, np.memmap)
+        np.testing.assert_array_equal(spilled, samples)
+        self.assertEqual(len(audio.read_pcm_stream(io.BytesIO(b''))), 0)
+
+    def test_decode_wav_to_16k_mono_int16(self):
+        fd, filename = tempfile.mkstemp(suffix='.wav')
+        os.close(fd)
+        try:
+            mono = synthetic_clip(16000, seconds=0.5)
+            wav.write(filename, 16000, mono)
+            rate, samples = audio.decode_wav(filename)
+            self.assertEqual(rate, 16000)
+            np.testing.assert_array_equal(samples, mono)
+            t = np.arange(48000) / 48000.0
+            tone = 0.5 * np.sin(2 * np.pi * 440 * t)
+            wav.write(filename, 48000, np.stack([tone, tone], axis=1).astype(np.float32))
+            rate, samples = audio.decode_wav(filename)
+            self.assertEqual((rate, samples.dtype, samples.shape), (16000, np.int16, (16000,)))
+            expected = 0.5 * 32767 * np.sin(2 * np.pi * 440 * np.arange(16000) / 16000.0)
+            np.testing.assert_allclose(samples[100:-100], expected[100:-100], atol=50)
+            wav.write(filename, 8000, synthetic_clip(8000, seconds=0.5))
+            rate, samples = audio.decode_wav(filename)
+            self.assertEqual((rate, samples.dtype, samples.shape), (16000, np.int16, (8000,)))
+        finally:
+            os.remove(filename)
+
+
+def reference_detect_speech(v):
+    """Original window-by-window detect_speech, with the frequency/energy dict."""
+    detected_windows = np.array([])
+    sample_window = int(v.rate * v.sample_window)
+    sample_overlap = int(v.rate * v.sample_overlap)
+    data = v.data
+    sample_start = 0
+    while (sample_start < (len(data) - sample_window)):
+        data_window = data[sample_start:sample_start + sample_window]
+        data_freq = np.fft.fftfreq(len(data_window), 1.0/v.rate)[1:]
+        data_energy = (np.abs(np.fft.fft(data_window))[1:]) ** 2
+        energy_freq = {}
+        for (i, freq) in enumerate(data_freq):
+            if abs(freq) not in energy_freq:
+                energy_freq[abs(freq)] = data_energy[i] * 2
+        sum_voice_energy = sum(e for (f, e) in energy_freq.items() if v.speech_start_band < f < v.speech_end_band)
+        speech_ratio = sum_voice_energy / sum(energy_freq.values())
+        detected_windows = np.append(detected_windows, [sample_start, speech_ratio > v.speech_energy_threshold])
+        sample_start += sample_overlap
+    detected_windows = detected_windows.reshape(int(len(detected_windows)/2), 2)
+    detected_windows[:,1] = v._smooth_speech_detection(detected_windows)
+    return detected_windows
+
+
+class VADTests(SimpleTestCase):
+
+    def setUp(self):
+        self.filenames = []
+
+    def tearDown(self):
+        for filename in self.filenames:
+            os.remove(filename)
+
+    def write_wav(self, rate, sig):
+        fd, filename = tempfile.mkstemp(suffix='.wav')
+        os.close(fd)
+        wav.write(filename, rate, sig)
+        self.filenames.append(filename)
+        return filename
+
+    def test_detect_speech_matches_reference(self):
+        rng = np.random.RandomState(0)
+        for rate in (8000, 16000, 22050):
+            sig = np.concatenate([synthetic_clip(rate, seconds=0.4, seed=seed) for seed in range(3)])
+            sig[rate // 2:rate] = rng.normal(0, 20, rate // 2).astype(np.int16)
+            for threshold in (0.2, 0.5):
+                v = vad.VoiceActivityDetector(self.write_wav(rate, sig), threshold=threshold, cache=False)
+                np.testing.assert_array_equal(v.detect_speech(), reference_detect_speech(v))
+
+    def test_stereo_is_mixed_down_per_batch(self):
+        rate = 8000
+        # loud enough for the sum of the two channels to overflow int16
+        left = np.concatenate([synthetic_clip(rate, seconds=0.4, seed=seed) for seed in range(3)]) * 3
+        right = np.roll(left, 1234)
+        stereo = np.stack([left, right], axis=1)
+        v = vad.VoiceActivityDetector(self.write_wav(rate, stereo), cache=False)
+        self.assertIsInstance(v.data, np.memmap)
+        self.assertEqual(v.data.shape, stereo.shape)
+        mono = vad.VoiceActivityDetector(self.write_wav(rate, left), cache=False)
+        mono.data = np.mean(stereo, axis=1, dtype=np.float64)
+        np.testing.assert_array_equal(v.detect_speech(), reference_detect_speech(mono))
+
+    def test_mix_to_mono_does_not_overflow(self):
+        stereo = np.array([[30000, 30000], [-30000, -29000]], dtype=np.int16)
+        np.testing.assert_array_equal(audio.mix_to_mono(stereo), [30000, -29500])
+        self.assertEqual(audio.mix_to_mono(stereo, np.float32).dtype, np.float32)
+        np.testing.assert_array_equal(clips.mono_clip(stereo), np.array([30000, -29500], dtype=np.int16))
+
+    def test_streaming_matches_batch_labels(self):
+        rate = 16000
+        rng = np.random.RandomState(1)
+        parts = []
+        for seed in range(6):
+            parts.append(synthetic_clip(rate, seconds=0.6, seed=seed))
+            parts.append(rng.normal(0, 20, int(rate * rng.uniform(0.3, 0.8))).astype(np.int16))
+        sig = np.concatenate(parts)
+        v = vad.VoiceActivityDetector(self.write_wav(rate, sig), threshold=0.3, cache=False)
+        expected = v.convert_windows_to_readible_labels(v.detect_speech())
+        self.assertTrue(expected)
+        for chunk_size in (1, 997, 16000, len(sig)):
+            stream = vad.StreamingVoiceActivityDetector(rate, threshold=0.3)
+            chunks = [sig[i:i+chunk_size] for i in range(0, len(sig), chunk_size)]
+            self.assertEqual(list(stream.detect(chunks)), expected)
+        # raw little-endian bytes, split in the middle of a sample
+        stream = vad.StreamingVoiceActivityDetector(rate, threshold=0.3)
+        data = sig.astype('<i2').tobytes()
+        self.assertEqual(list(stream.detect([data[i:i+1001] for i in range(0, len(data), 1001)])), expected)
+
+    def test_streaming_shares_constants_not_file_api(self):
+        stream = vad.StreamingVoiceActivityDetector(16000, window=0.3, threshold=0.4)
+        for name in ('sample_window', 'sample_overlap', 'speech_start_band', 'speech_end_band'):
+            self.assertEqual(getattr(stream, name), getattr(vad.VoiceActivityDetector, name))
+        self.assertEqual((stream.speech_window, stream.speech_energy_threshold), (0.3, 0.4))
+        self.assertNotIsInstance(stream, vad.VoiceActivityDetector)
+        self.assertFalse(hasattr(stream, 'detect_speech') or hasattr(stream, 'sweep'))
+
+    def test_sweep_matches_separate_runs(self):
+        rate = 16000
+        rng = np.random.RandomState(2)
+        sig = np.concatenate([synthetic_clip(rate, seconds=0.5, seed=0),
+                              rng.normal(0, 20, rate // 2).astype(np.int16),
+                              synthetic_clip(rate, seconds=0.5, seed=1),
+                              rng.normal(0, 20, rate // 2).astype(np.int16)])
+        filename = self.write_wav(rate, sig)
+        results = vad.VoiceActivityDetector(filename, cache=False).sweep([0.2, 0.4], [0.1, 0.5])
+        self.assertEqual(len(results), 4)
+        for (threshold, window), labels in results.items():
+            v = vad.VoiceActivityDetector(filename, window=window, threshold=threshold, cache=False)
+            self.assertEqual(labels, v.convert_windows_to_readible_labels(v.detect_speech()))
+
+
+def reference_filterbanks(nfilt, nfft, samplerate, lowfreq=0, highfreq=None):
+    """Original nested-loop filterbank construction (ported from xrange)."""
+    highfreq = highfreq or samplerate/2
+    melpoints = np.linspace(features.hz2mel(lowfreq), features.hz2mel(highfreq), nfilt+2)
+    bin = np.floor((nfft+1)*features.mel2hz(melpoints)/samplerate)
+    fbank = np.zeros([nfilt, nfft//2+1])
+    for j in range(0, nfilt):
+        for i in range(int(bin[j]), int(bin[j+1])):
+            fbank[j,i] = (i - bin[j])/(bin[j+1]-bin[j])
+        for i in range(int(bin[j+1]), int(bin[j+2])):
+            fbank[j,i] = (bin[j+2]-i)/(bin[j+2]-bin[j+1])
+    return fbank
+
+
+class FeaturesTests(SimpleTestCase):
+
+    def test_filterbanks_match_reference(self):
+        for (nfilt, nfft, samplerate, lowfreq, highfreq) in [(26, 512, 16000, 0, None), (40, 512, 16000, 300, 3000),
+                                                             (20, 256, 8000, 0, None), (80, 1024, 44100, 0, 8000)]:
+            np.testing.assert_allclose(features.get_filterbanks(nfilt, nfft, samplerate, lowfreq, highfreq),
+                                       reference_filterbanks(nfilt, nfft, samplerate, lowfreq, highfreq))
+
+    def test_filterbanks_are_memoized(self):
+        fb = features.get_filterbanks(26, 512, 16000)
+        self.assertIs(features.get_filterbanks(26, 512, 16000, 0, 8000), fb)
+        self.assertFalse(fb.flags.writeable)
+
+    def test_mfcc_and_logfbank(self):
+        sig = synthetic_clip(16000, seconds=0.5).astype(np.float64)
+        self.assertEqual(features.mfcc(sig, 16000).shape, (49, 13))
+        self.assertEqual(features.logfbank(sig, 16000, nfilt=40).shape, (49, 40))
+
+    def test_framesig_matches_index_matrix(self):
+        sig = np.arange(1000, dtype=np.float64)
+        for (frame_len, frame_step) in [(400, 160), (250, 250), (1000, 10), (1200, 100)]:
+            frames = sigproc.framesig(sig, frame_len, frame_step)
+            numframes = len(frames)
+            padsignal = np.concatenate((sig, np.zeros((numframes-1)*frame_step + frame_len - len(sig))))
+            indices = np.tile(np.arange(0, frame_len), (numframes, 1)) + np.tile(np.arange(0, numframes*frame_step, frame_step), (frame_len, 1)).T
+            np.testing.assert_array_equal(frames, padsignal[indices])
+            self.assertFalse(frames.flags.writeable)
+        # no padding needed: frames are a view of the signal itself
+        self.assertTrue(np.shares_memory(sigproc.framesig(sig, 200, 100), sig))
+        hamming = sigproc.framesig(sig, 400, 160, winfunc=np.hamming)
+        np.testing.assert_allclose(hamming, sigproc.framesig(sig, 400, 160) * np.hamming(400))
+
+    def test_deframesig_inverts_framesig(self):
+        sig = np.random.RandomState(0).normal(size=1000)
+        for winfunc in (None, lambda n: np.hanning(n) + 0.1):
+            frames = sigproc.framesig(sig, 400, 160, winfunc)
+            np.testing.assert_allclose(sigproc.deframesig(frames, len(sig), 400, 160, winfunc), sig)
+
+
+class FeatureCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.cache = feature_cache.FeatureCache(self.cache_dir.name)
+        fd, self.filename = tempfile.mkstemp(suffix='.wav')
+        os.close(fd)
+        self.rate = 16000
+        self.sig = np.concatenate([synthetic_clip(self.rate, seconds=0.25, seed=seed) for seed in range(2)])
+        wav.write(self.filename, self.rate, self.sig)
+
+    def tearDown(self):
+        os.remove(self.filename)
+        self.cache_dir.cleanup()
+
+    def test_get_or_compute_is_keyed_by_content_and_params(self):
+        calls = []
+        def compute():
+            calls.append(1)
+            return np.arange(10.0)
+        first = self.cache.get_or_compute(self.filename, 'x', {'a': 1}, compute)
+        second = self.cache.get_or_compute(self.filename, 'x', {'a': 1}, compute)
+        np.testing.assert_array_equal(first, second)
+        self.assertIsInstance(second, np.memmap)
+        self.assertEqual(len(calls), 1)
+        self.cache.get_or_compute(self.filename, 'x', {'a': 2}, compute)
+        self.assertEqual(len(calls), 2)
+        # a copy of the same audio under another name hits the same entry
+        fd, copy = tempfile.mkstemp(suffix='.wav')
+        os.close(fd)
+        wav.write(copy, self.rate, self.sig)
+        self.cache.get_or_compute(copy, 'x', {'a': 1}, compute)
+        os.remove(copy)
+        self.assertEqual(len(calls), 2)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.max_bytes = 3 * (np.zeros(100).nbytes + 128)
+        for i in range(3):
+            self.cache.put(self.filename, 'x', {'i': i}, np.zeros(100))
+            path = self.cache._path(self.filename, 'x', {'i': i})
+            os.utime(path, (i, i))
+        self.assertIsNotNone(self.cache.get(self.filename, 'x', {'i': 0}))
+        self.cache.put(self.filename, 'x', {'i': 3}, np.zeros(100))
+        self.assertIsNone(self.cache.get(self.filename, 'x', {'i': 1}))
+        for i in (0, 2, 3):
+            self.assertIsNotNone(self.cache.get(self.filename, 'x', {'i': i}))
+
+    def test_backends_reuse_cached_results(self):
+        expected = khanaga.get_results(self.filename, cache=False)
+        self.assertEqual(khanaga.get_results(self.filename, cache=self.cache), expected)
+        self.assertEqual(khanaga.get_results(self.filename, cache=self.cache), expected)
+        v = vad.VoiceActivityDetector(self.filename, cache=False)
+        for i in range(2):
+            cached = vad.VoiceActivityDetector(self.filename, cache=self.cache)
+            np.testing.assert_array_equal(cached.detect_speech(), v.detect_speech())
+        self.assertEqual(len(os.listdir(os.path.join(self.cache_dir.name, feature_cache.audio_hash(self.filename)))), 3)
+
+    def test_new_algorithm_version_misses_the_cache(self):
+        khanaga.get_results(self.filename, cache=self.cache)
+        vad.VoiceActivityDetector(self.filename, cache=self.cache).detect_speech()
+        with mock.patch.object(khanaga, "BOUNDARIES_VERSION", khanaga.BOUNDARIES_VERSION + 1), \
+                mock.patch.object(vad, "SPEECH_RATIOS_VERSION", vad.SPEECH_RATIOS_VERSION + 1):
+            khanaga.get_results(self.filename, cache=self.cache)
+            vad.VoiceActivityDetector(self.filename, cache=self.cache).detect_speech()
+        self.assertEqual(len(os.listdir(os.path.join(self.cache_dir.name, feature_cache.audio_hash(self.filename)))), 6)
+
+    def test_normalized_audio_cache(self):
+        digest = feature_cache.audio_hash(self.filename)
+        self.assertIsNone(feature_cache.decoded_audio(digest, cache=self.cache))
+        rate, samples = feature_cache.decode_cached(self.filename, cache=self.cache)
+        self.assertEqual(rate, feature_cache.NORMALIZED_RATE)
+        np.testing.assert_array_equal(samples, self.sig)
+        # client-supplied hashes never reach the file system unchecked
+        self.assertFalse(feature_cache.is_sha256("../" + digest[3:]))
+        self.assertFalse(feature_cache.is_sha256(digest.upper()))
+        with self.assertRaises(ValueError):
+            feature_cache.decoded_audio("../../etc", cache=self.cache)
+        # a client that only sends the hash gets the same audio back
+        rate, cached = feature_cache.decoded_audio(digest, cache=self.cache)
+        self.assertIsInstance(cached, np.memmap)
+        np.testing.assert_array_equal(cached, self.sig)
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(feature_cache.sha256_of_chunks(iter(lambda: f.read(1000), b'')), digest)
+
+    def test_file_features(self):
+        mfcc = feature_cache.file_features(self.filename, 'mfcc', cache=self.cache)
+        np.testing.assert_allclose(mfcc, features.mfcc(self.sig.astype(np.float64), samplerate=self.rate))
+        self.assertIsInstance(feature_cache.file_features(self.filename, 'mfcc', cache=self.cache), np.memmap)
+
+
+class Float32Tests(SimpleTestCase):
+
+    def setUp(self):
+        self.rate = 16000
+        self.sig = np.concatenate([synthetic_clip(self.rate, seconds=0.25, seed=seed) for seed in range(4)])
+        fd, self.filename = tempfile.mkstemp(suffix='.wav')
+        os.close(fd)
+        wav.write(self.filename, self.rate, self.sig)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_khanaga_matches_float64(self):
+        SE64, ACC64 = khanaga.compute_ACC(self.sig, self.rate)
+        SE32, ACC32 = khanaga.compute_ACC(self.sig, self.rate, np.float32)
+        self.assertEqual(ACC32.dtype, np.float32)
+        self.assertEqual(SE32.dtype, np.float32)
+        np.testing.assert_allclose(ACC32, ACC64, atol=1e-4)
+        np.testing.assert_allclose(SE32, SE64, rtol=1e-4, atol=1e-4)
+        for target_rate in (None, 8000):
+            for lowpass in (False, True):
+                bounds64 = khanaga.find_boundaries(self.sig, self.rate, lowpass, 0.0001, target_rate=target_rate)
+                bounds32 = khanaga.find_boundaries(self.sig, self.rate, lowpass, 0.0001, target_rate=target_rate, float_dtype=np.float32)
+                HR, OS, FA = khanaga.partial(bounds32, bounds64, 1, self.rate)
+                self.assertGreaterEqual(khanaga.F1(HR, FA), 0.95)
+
+    def test_vad_matches_float64(self):
+        for target_rate in (None, 8000):
+            v64 = vad.VoiceActivityDetector(self.filename, target_rate=target_rate, cache=False)
+            v32 = vad.VoiceActivityDetector(self.filename, target_rate=target_rate, cache=False, float_dtype=np.float32)
+            ratios64 = v64._calculate_speech_ratios()[1]
+            ratios32 = v32._calculate_speech_ratios()[1]
+            self.assertEqual(ratios32.dtype, np.float32)
+            np.testing.assert_allclose(ratios32, ratios64, atol=1e-4)
+            self.assertLessEqual(np.mean(v32.detect_speech()[:, 1] != v64.detect_speech()[:, 1]), 0.01)
+
+    def test_streaming_vad_in_float32(self):
+        v = vad.VoiceActivityDetector(self.filename, cache=False, float_dtype=np.float32)
+        stream = vad.StreamingVoiceActivityDetector(self.rate, float_dtype=np.float32)
+        labels = list(stream.detect(np.array_split(self.sig, 7)))
+        self.assertEqual(labels, v.convert_windows_to_readible_labels(v.detect_speech()))
+
+    def test_features_keep_float32(self):
+        sig64 = self.sig.astype(np.float64)
+        sig32 = self.sig.astype(np.float32)
+        frames = sigproc.framesig(sig32, 400, 160, winfunc=np.hamming)
+        self.assertEqual(frames.dtype, np.float32)
+        self.assertEqual(sigproc.deframesig(frames, len(sig32), 400, 160, np.hamming).dtype, np.float32)
+        self.assertEqual(sigproc.powspec(frames, 512).dtype, np.float32)
+        mfcc32 = features.mfcc(sig32, samplerate=self.rate)
+        self.assertEqual(mfcc32.dtype, np.float32)
+        np.testing.assert_allclose(mfcc32, features.mfcc(sig64, samplerate=self.rate), rtol=1e-3, atol=1e-3)
+        np.testing.assert_allclose(features.ssc(sig32, samplerate=self.rate), features.ssc(sig64, samplerate=self.rate), rtol=1e-3)
+
+    def test_features_keep_float32_with_double_precision_rfft(self):
+        # NumPy < 2 always returns complex128 from rfft
+        rfft = np.fft.rfft
+        with mock.patch.object(np.fft, 'rfft', lambda *args, **kwargs: rfft(*args, **kwargs).astype(np.complex128)):
+            frames = sigproc.framesig(self.sig.astype(np.float32), 400, 160, winfunc=np.hamming)
+            self.assertEqual(sigproc.powspec(frames, 512).dtype, np.float32)
+            self.assertEqual(features.mfcc(self.sig.astype(np.float32), samplerate=self.rate).dtype, np.float32)
+
+
+_resident_model = None
+
+
+def resident_model_plugin(samples, params=None, sample_rate=None):
+    """ Plugin for the TranscriptionExecutor tests: reports the process it ran
+    in and the model it found loaded there.
+    """
+    return (os.getpid(), _resident_model, int(samples.sum()))
+
+
+def _load_resident_model():
+    global _resident_model
+    _resident_model = os.getpid()
+
+
+resident_model_plugin.audio_input = "array"
+resident_model_plugin.preload = _load_resident_model
+
+
+def crashing_plugin(samples, params=None, sample_rate=None):
+    """ Plugin whose worker dies (as if killed for running out of memory) when asked to. """
+    if params.get("crash"):
+        os._exit(1)
+    return len(samples)
+
+
+crashing_plugin.audio_input = "array"
+
+
+class ClipsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.rate = 16000
+        self.sig = np.concatenate([synthetic_clip(self.rate, seconds=0.25, seed=seed) for seed in range(4)])
+        fd, self.filename = tempfile.mkstemp(suffix='.wav')
+        os.close(fd)
+        wav.write(self.filename, self.rate, self.sig)
+        self.segments = [{'start': 0, 'end': 250, 'value': ""}, {'start': 300, 'end': 1000, 'value': ""}]
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_array_plugins_get_views_of_one_buffer(self):
+        received = []
+        def plugin(samples, params=None, sample_rate=None):
+            received.append((samples, sample_rate))
+            return len(samples)
+        plugin.audio_input = clips.AUDIO_INPUT_ARRAY
+        output = clips.run_on_clips(plugin, *audio.read_wav(self.filename), self.segments, {"lang": "eng"})
+        self.assertEqual(output, [{"start": 0, "end": 250, "transcription": 4000},
+                                  {"start": 300, "end": 1000, "transcription": 11200}])
+        np.testing.assert_array_equal(received[1][0], self.sig[4800:16000])
+        self.assertEqual(received[1][1], self.rate)
+        self.assertIsInstance(received[0][0], np.memmap)
+
+    def test_file_plugins_get_wav_clips(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        def plugin(path, params=None):
+            rate, data = wav.read(path)
+            self.assertEqual(os.path.dirname(path), tmp_dir.name)
+            return (rate, data.tolist())
+        output = clips.run_on_clips(plugin, *audio.read_wav(self.filename), [], {"lang": "eng"}, tmp_dir=tmp_dir.name)
+        self.assertEqual(output, [{"start": 0, "end": 1000, "transcription": (self.rate, self.sig.tolist())}])
+        # clip files are removed once the plugin is done with them
+        self.assertEqual(os.listdir(tmp_dir.name), [])
+        tmp_dir.cleanup()
+
+    def test_batches_are_bounded(self):
+        pairs = [({'start': i}, np.zeros(n)) for i, n in enumerate([10, 10, 30, 5, 5, 5, 50])]
+        batches = list(clips.iter_batches(pairs, 10, max_clips=3, max_seconds=4))
+        self.assertEqual([[segment['start'] for segment, _ in batch] for batch in batches], [[0, 1], [2, 3, 4], [5], [6]])
+
+    def test_batch_entry_point_is_used_when_available(self):
+        calls = []
+        def plugin(samples, params=None, sample_rate=None):
+            calls.append(1)
+            return len(samples)
+        def batch(samples_list, params=None, sample_rate=None):
+            calls.append(len(samples_list))
+            return [len(samples) for samples in samples_list]
+        plugin.audio_input = clips.AUDIO_INPUT_ARRAY
+        segments = [{'start': 100 * i, 'end': 100 * i + 50, 'value': ""} for i in range(10)]
+        expected = clips.run_on_clips(plugin, *audio.read_wav(self.filename), segments, {})
+        self.assertEqual(calls, [1] * 10)
+        plugin.batch = batch
+        calls.clear()
+        output = clips.run_on_clips(plugin, *audio.read_wav(self.filename), segments, {}, max_batch_clips=4)
+        self.assertEqual(output, expected)
+        self.assertEqual(calls, [4, 4, 2])
+        reported = []
+        clips.run_on_clips(plugin, *audio.read_wav(self.filename), segments, {}, max_batch_clips=4,
+                           progress=lambda results, total: reported.append((len(results), total)))
+        self.assertEqual(reported, [(4, 10), (8, 10), (10, 10)])
+
+    def test_executor_keeps_segment_order_and_models_resident(self):
+        rate, data = audio.read_wav(self.filename)
+        segments = [{'start': 10 * i, 'end': 10 * i + 30, 'value': ""} for i in range(97)]
+        with clips.TranscriptionExecutor(resident_model_plugin, workers=2) as executor:
+            output = executor.run(rate, data, segments, {}, max_batch_clips=5)
+        self.assertEqual([o["start"] for o in output], [s["start"] for s in segments])
+        self.assertEqual([o["transcription"][2] for o in output],
+                         [int(clips.clip_samples(rate, data, s["start"], s["end"]).sum()) for s in segments])
+        # every clip ran in a worker process whose model was loaded at start-up
+        self.assertTrue(all(pid == model and pid != os.getpid() for (pid, model, _) in (o["transcription"] for o in output)))
+        self.assertLessEqual(len(set(o["transcription"][0] for o in output)), 2)
+        serial = clips.transcribe(resident_model_plugin, rate, data, segments, {}, workers=1)
+        self.assertEqual([o["transcription"][2] for o in serial], [o["transcription"][2] for o in output])
+
+    def test_broken_pool_is_replaced(self):
+        from concurrent.futures.process import BrokenProcessPool
+        rate, data = audio.read_wav(self.filename)
+        try:
+            with self.assertRaises(BrokenProcessPool):
+                clips.transcribe(crashing_plugin, rate, data, self.segments, {"crash": True}, workers=2)
+            self.assertNotIn((crashing_plugin, 2, 1), clips._executors)
+            output = clips.transcribe(crashing_plugin, rate, data, self.segments, {}, workers=2)
+            self.assertEqual([o["transcription"] for o in output], [4000, 11200])
+        finally:
+            clips.discard_executor(crashing_plugin, 2, 1)
+
+    def test_job_pools_do_not_outlive_the_call(self):
+        rate, data = audio.read_wav(self.filename)
+        output = clips.transcribe(crashing_plugin, rate, data, self.segments, {}, workers=2, keep_workers=False)
+        self.assertEqual([o["transcription"] for o in output], [4000, 11200])
+        self.assertNotIn((crashing_plugin, 2, 1), clips._executors)
+        self.assertEqual(multiprocessing.active_children(), [])
+
+
+
+def file_diarization_plugin(path, segments, speakers):
+    """Module-level diarization plugin taking wav paths, so worker processes can unpickle it."""
+    rate, data = wav.read(path)
+    return [{"start": 0, "end": len(data) * 1000 // rate, "value": speakers[0], "pid": os.getpid()}]
+
+
+class DiarizationTests(SimpleTestCase):
+
+    def setUp(self):
+        self.rate = 16000
+        self.filenames = []
+        for seconds in [0.25, 0.5, 0.75]:
+            fd, filename = tempfile.mkstemp(suffix='.wav')
+            os.close(fd)
+            wav.write(filename, self.rate, synthetic_clip(self.rate, seconds=seconds))
+            self.filenames.append(filename)
+
+    def tearDown(self):
+        for filename in self.filenames:
+            os.remove(filename)
+
+    def test_results_are_keyed_by_file(self):
+        files = list(zip(diarization.unique_names(["a.wav", "b.wav", "a.wav"]), self.filenames))
+        self.assertEqual([name for name, _ in files], ["a.wav", "b.wav", "a.wav (2)"])
+        reported = []
+        results = diarization.diarize_files(file_diarization_plugin, files, [[0.0, 0.1]], ["spk"], workers=2,
+                                            progress=lambda results, total: reported.append((len(results), total)))
+        self.assertEqual(list(results), ["a.wav", "b.wav", "a.wav (2)"])
+        self.assertEqual([r[0]["end"] for r in results.values()], [250, 500, 750])
+        self.assertTrue(all(r[0]["pid"] != os.getpid() for r in results.values()))
+        self.assertEqual(reported, [(1, 3), (2, 3), (3, 3)])
+
+    def test_array_plugins_read_the_audio_cache(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        cache = feature_cache.FeatureCache(cache_dir.name, 1 << 30)
+        digest = feature_cache.audio_hash(self.filenames[1])
+        feature_cache.decode_cached(self.filenames[1], digest, cache=cache)
+        def plugin(samples, segments, speakers, sample_rate=None):
+            return [len(samples), sample_rate]
+        plugin.audio_input = clips.AUDIO_INPUT_ARRAY
+        results = diarization.diarize_files(plugin, [("b.wav", digest)], [], [], workers=1, cache=cache)
+        self.assertEqual(results, {"b.wav": [8000, 16000]})
+        with self.assertRaises(ValueError):
+            diarization.diarize(plugin, "0" * 64, [], [], cache=cache)
+        cache_dir.cleanup()
+
+    def test_speaker_embeddings_are_cached(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        cache = feature_cache.FeatureCache(cache_dir.name, 1 << 30)
+        calls = []
+        def plugin(path, segments, speakers):
+            self.fail("plugins that split their work are not called directly")
+        def embed(path, window=None, step=None):
+            calls.append((window, step))
+            rate, data = wav.read(path)
+            starts = np.arange(0, len(data) / rate - window + 1e-9, step)
+            return np.stack([starts, starts + window], axis=1)
+        def assign(embeddings, segments, speakers, window=None, step=None, threshold=None):
+            return [len(embeddings), speakers, threshold]
+        plugin.embed = embed
+        plugin.assign = assign
+        path = self.filenames[2]
+        params = {"window": 0.25, "step": 0.125}
+        self.assertEqual(diarization.diarize(plugin, path, [], ["a"], dict(params, threshold=0.3), embedding_cache=cache), [5, ["a"], 0.3])
+        # another threshold or other reference segments reuse the embeddings
+        self.assertEqual(diarization.diarize(plugin, path, [[0, 1]], ["b"], dict(params, threshold=0.6), embedding_cache=cache), [5, ["b"], 0.6])
+        self.assertEqual(calls, [(0.25, 0.125)])
+        # other window parameters do not
+        self.assertEqual(diarization.diarize(plugin, path, [], ["a"], {"window": 0.5, "step": 0.25}, embedding_cache=cache), [2, ["a"], 0.45])
+        self.assertEqual(calls[1:], [(0.5, 0.25)])
+        cache_dir.cleanup()
+
+
+
+class FinetuneDataTests(SimpleTestCase):
+
+    def setUp(self):
+        self.rate = 16000
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        corpus_dir = os.path.join(self.tmp_dir.name, "corpus")
+        os.makedirs(os.path.join(corpus_dir, "train"))
+        self.recordings = {}
+        for seed in range(3):
+            name = f"rec{seed}"
+            self.recordings[name] = synthetic_clip(self.rate, seconds=1.0, seed=seed)
+            wav.write(os.path.join(corpus_dir, "train", name + ".wav"), self.rate, self.recordings[name])
+            with open(os.path.join(corpus_dir, "train", name + ".json"), 'w') as f:
+                json.dump({"0-250": [f"a {seed}"], "500-900": [f"b {seed}"]}, f)
+        self.archive = shutil.make_archive(os.path.join(self.tmp_dir.name, "corpus"), 'zip', corpus_dir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_recordings_are_sliced_and_linked(self):
+        for workers in [1, 2]:
+            data_dir = os.path.join(self.tmp_dir.name, f"data{workers}")
+            self.assertEqual(finetune_data.prepare_dataset([self.archive], data_dir, workers=workers), 6)
+            train_dir = os.path.join(data_dir, "train")
+            self.assertEqual(len(os.listdir(train_dir)), 12)
+            rate, clip = wav.read(os.path.join(train_dir, "rec1_500-900.wav"))
+            np.testing.assert_array_equal(clip, self.recordings["rec1"][8000:14400])
+            with open(os.path.join(train_dir, "rec2_0-250.txt")) as f:
+                self.assertEqual(f.read(), "a 2")
+            # validate holds the same files, not copies of them
+            for name in os.listdir(train_dir):
+                self.assertTrue(os.path.samefile(os.path.join(train_dir, name), os.path.join(data_dir, "validate", name)))
+
+    def test_shards_match_the_wav_layout(self):
+        wav_dir = os.path.join(self.tmp_dir.name, "wav")
+        finetune_data.prepare_dataset([self.archive], wav_dir, workers=1)
+        for workers in [1, 2]:
+            data_dir = os.path.join(self.tmp_dir.name, f"shard{workers}")
+            self.assertEqual(finetune_data.prepare_dataset([self.archive], data_dir, workers=workers,
+                                                           dataset_format=finetune_data.DATASET_FORMAT_SHARD), 6)
+            self.assertEqual(sorted(os.listdir(data_dir)), ["train.index.json", "train.pcm", "validate.index.json"])
+            for split in ["train", "validate"]:
+                shard = finetune_data.Shard(data_dir, split)
+                self.assertEqual(len(shard), 6)
+                self.assertEqual(shard.rate, self.rate)
+                self.assertIsInstance(shard.audio, np.memmap)
+                for (segment_id, samples, transcription) in shard:
+                    rate, clip = wav.read(os.path.join(wav_dir, "train", segment_id + ".wav"))
+                    np.testing.assert_array_equal(samples, clip)
+                    with open(os.path.join(wav_dir, "train", segment_id + ".txt")) as f:
+                        self.assertEqual(transcription, f.read())
+
+
+class UploadTests(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.data = np.random.RandomState(0).bytes(3 * uploads.UPLOAD_BLOCK_BYTES // 2)
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def test_chunks_are_written_in_place_and_hashed(self):
+        meta = uploads.start_upload("../../speech.wav", len(self.data), root=self.root.name)
+        self.assertEqual(meta["filename"], "speech.wav")
+        meta = uploads.append_chunk(meta, io.BytesIO(self.data[:1000]), root=self.root.name)
+        self.assertEqual(meta["offset"], 1000)
+        self.assertFalse(meta["complete"])
+        meta = uploads.append_chunk(meta, io.BytesIO(self.data[1000:]), root=self.root.name)
+        self.assertTrue(meta["complete"])
+        self.assertEqual(meta["sha256"], hashlib.sha256(self.data).hexdigest())
+        with open(uploads.upload_path(meta, root=self.root.name), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(uploads.get_upload(meta["upload_id"], root=self.root.name), meta)
+
+    def test_resume_in_another_process(self):
+        meta = uploads.start_upload("scan.pdf", root=self.root.name)
+        uploads.append_chunk(meta, io.BytesIO(self.data[:5000]), root=self.root.name)
+        # a fresh process has no running hash, and a failed attempt left extra bytes behind
+        uploads._hashes.clear()
+        with open(uploads.upload_path(meta, root=self.root.name), 'ab') as f:
+            f.write(b"partial")
+        meta = uploads.get_upload(meta["upload_id"], root=self.root.name)
+        meta = uploads.append_chunk(meta, io.BytesIO(self.data[5000:]), root=self.root.name)
+        meta = uploads.finish_upload(meta, root=self.root.name)
+        self.assertEqual(meta["sha256"], hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(os.path.getsize(uploads.upload_path(meta, root=self.root.name)), len(self.data))
+
+    def test_invalid_uploads(self):
+        self.assertIsNone(uploads.get_upload("../etc", root=self.root.name))
+        self.assertIsNone(uploads.get_upload("0" * 32, root=self.root.name))
+        meta = uploads.start_upload("corpus.zip", 10, root=self.root.name)
+        with self.assertRaises(ValueError):
+            uploads.append_chunk(meta, io.BytesIO(self.data[:11]), root=self.root.name)
+        meta = uploads.append_chunk(meta, io.BytesIO(self.data[:10]), root=self.root.name)
+        with self.assertRaises(ValueError):
+            uploads.append_chunk(meta, io.BytesIO(b"x"), root=self.root.name)
+
+    def test_rejected_chunk_leaves_the_hash_alone(self):
+        meta = uploads.start_upload("speech.wav", len(self.data), root=self.root.name)
+        meta = uploads.append_chunk(meta, io.BytesIO(self.data[:1000]), root=self.root.name)
+        with self.assertRaises(ValueError):
+            uploads.append_chunk(meta, io.BytesIO(self.data[1000:] + b"extra"), root=self.root.name)
+        self.assertEqual(os.path.getsize(uploads.upload_path(meta, root=self.root.name)), 1000)
+        meta = uploads.get_upload(meta["upload_id"], root=self.root.name)
+        meta = uploads.append_chunk(meta, io.BytesIO(self.data[1000:]), root=self.root.name)
+        self.assertEqual(meta["sha256"], hashlib.sha256(self.data).hexdigest())
+
+    def test_retried_chunk_waits_for_the_first_and_conflicts(self):
+        meta = uploads.start_upload("speech.wav", len(self.data), root=self.root.name, owner="ann")
+        self.assertEqual(meta["owner"], "ann")
+        writing = threading.Event()
+        class SlowStream(io.BytesIO):
+            def read(self, n=-1):
+                writing.set()
+                time.sleep(0.01)
+                return super().read(min(n, 4096))
+        first = threading.Thread(target=uploads.append_chunk,
+                                 args=(meta, SlowStream(self.data[:40000]), self.root.name, 0))
+        first.start()
+        writing.wait()
+        # the retry of the same chunk blocks on the lock, then finds the upload has moved on
+        with self.assertRaises(uploads.UploadConflict) as conflict:
+            uploads.append_chunk(meta, io.BytesIO(self.data[:40000]), root=self.root.name, offset=0)
+        first.join()
+        self.assertEqual(conflict.exception.meta["offset"], 40000)
+        self.assertEqual(os.path.getsize(uploads.upload_path(meta, root=self.root.name)), 40000)
+
+    def test_old_uploads_are_removed(self):
+        old = uploads.start_upload("old.wav", root=self.root.name)
+        uploads.append_chunk(old, io.BytesIO(b"abc"), root=self.root.name)
+        recent = uploads.start_upload("recent.wav", root=self.root.name)
+        stale = time.time() - uploads.UPLOAD_MAX_AGE_SECONDS - 60
+        os.utime(os.path.join(self.root.name, old["upload_id"], "upload.json"), (stale, stale))
+        uploads.cleanup_uploads(root=self.root.name)
+        self.assertIsNone(uploads.get_upload(old["upload_id"], root=self.root.name))
+        self.assertNotIn(old["upload_id"], uploads._hashes)
+        self.assertEqual(uploads.get_upload(recent["upload_id"], root=self.root.name), recent)
+
+    def test_interrupted_stream_leaves_the_hash_alone(self):
+        class DroppedStream(io.BytesIO):
+            def read(self, n=-1):
+                block = super().read(min(n, 3000))
+                if self.tell() > 6000:
+                    raise ConnectionResetError("client went away")
+                return block
+        meta = uploads.start_upload("speech.wav", len(self.data), root=self.root.name)
+        meta = uploads.append_chunk(meta, io.BytesIO(self.data[:1000]), root=self.root.name)
+        with self.assertRaises(ConnectionResetError):
+            uploads.append_chunk(meta, DroppedStream(self.data[1000:]), root=self.root.name)
+        meta = uploads.get_upload(meta["upload_id"], root=self.root.name)
+        self.assertEqual(meta["offset"], 1000)
+        meta = uploads.append_chunk(meta, io.BytesIO(self.data[1000:]), root=self.root.name)
+        self.assertEqual(meta["sha256"], hashlib.sha256(self.data).hexdigest())
+
+    def test_uploads_are_only_handed_to_their_owner(self):
+        meta = uploads.start_upload("speech.wav", root=self.root.name, owner="alice")
+        self.assertEqual(uploads.owned_upload(meta["upload_id"], "alice", root=self.root.name), meta)
+        for owner in ("bob", "", None):
+            self.assertIsNone(uploads.owned_upload(meta["upload_id"], owner, root=self.root.name))
+
+
+@skipUnless(apps.is_installed("annotator"), "needs the project settings and database")
+class UploadViewTests(TestCase):
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from rest_framework.authtoken.models import Token
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        patcher = mock.patch.object(uploads, "UPLOAD_DIR", root.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tokens = {name: Token.objects.create(user=User.objects.create_user(name)).key for name in ("alice", "bob")}
+        meta = uploads.start_upload("scan.pdf", 4, owner="alice")
+        self.upload_id = uploads.append_chunk(meta, io.BytesIO(b"%PDF"))["upload_id"]
+
+    def test_other_user_cannot_consume_upload(self):
+        response = self.client.post("/annotator/ocr-post-correction/", {"file_upload_id": self.upload_id},
+                                    HTTP_AUTHORIZATION=self.tokens["bob"])
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get("/annotator/uploads/" + self.upload_id, HTTP_AUTHORIZATION=self.tokens["bob"])
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get("/annotator/uploads/" + self.upload_id, HTTP_AUTHORIZATION=self.tokens["alice"])
+        self.assertEqual(response.status_code, 200)
+
+    def test_annotate_needs_a_token_for_uploads(self):
+        response = self.client.post("/annotator/segment/1/annotate/1/",
+                                    {"params": '{"service": "phone_transcription"}', "file_upload_id": self.upload_id})
+        self.assertEqual(response.status_code, 401)
+
+
+class StubJob():
+    """Stand-in for an rq Job: meta, save_meta and the status accessors job_status uses."""
+
+    def __init__(self, status="started", result=None, exc_info=None):
+        self.id = "stub"
+        self.meta = {}
+        self.saved = []
+        self.status = status
+        self.result = result
+        self.exc_info = exc_info
+
+    def save_meta(self):
+        self.saved.append(dict(self.meta["progress"]))
+
+    def get_status(self):
+        return self.status
+
+    @property
+    def is_finished(self):
+        return self.status == "finished"
+
+    @property
+    def is_failed(self):
+        return self.status == "failed"
+
+
+class JobTests(SimpleTestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.cache = feature_cache.FeatureCache(self.cache_dir.name, 1 << 30)
+        fd, self.filename = tempfile.mkstemp(suffix='.wav')
+        os.close(fd)
+        wav.write(self.filename, 16000, synthetic_clip(16000, seconds=1.0))
+        self.digest = feature_cache.audio_hash(self.filename)
+        feature_cache.decode_cached(self.filename, self.digest, cache=self.cache)
+
+    def tearDown(self):
+        os.remove(self.filename)
+        self.cache_dir.cleanup()
+
+    def test_transcription_job_reports_progress(self):
+        def plugin(samples, params=None, sample_rate=None):
+            return len(samples)
+        def batch(samples_list, params=None, sample_rate=None):
+            return [len(samples) for samples in samples_list]
+        plugin.audio_input = clips.AUDIO_INPUT_ARRAY
+        plugin.batch = batch
+        segments = [{'start': 20 * i, 'end': 20 * i + 10, 'value': ""} for i in range(2 * clips.PLUGIN_BATCH_SIZE + 1)]
+        total = len(segments)
+        job = StubJob()
+        output = jobs.transcribe_cached_audio(job, plugin, [self.digest, self.digest], segments, {}, cache=self.cache)
+        self.assertEqual([o["transcription"] for o in output], [160] * total)
+        batch_ends = [clips.PLUGIN_BATCH_SIZE, 2 * clips.PLUGIN_BATCH_SIZE, total]
+        self.assertEqual(job.saved, [{"done": done, "total": total, "file": f, "files": 2} for f in (1, 2) for done in batch_ends])
+        self.assertEqual(job.meta["results"], output)
+        with self.assertRaises(ValueError):
+            jobs.transcribe_cached_audio(StubJob(), plugin, ["0" * 64], segments, {}, cache=self.cache)
+
+    def test_job_status_data(self):
+        job = StubJob()
+        jobs.progress_reporter(job)([{"start": 0}], 3)
+        self.assertEqual(jobs.job_status_data(job), {"job_id": "stub", "status": "started",
+                                                      "progress": {"done": 1, "total": 3}, "results": [{"start": 0}]})
+        done = jobs.job_status_data(StubJob("finished", result=["all"]))
+        self.assertEqual((done["status"], done["results"]), ("finished", ["all"]))
+        exc_info = 'Traceback (most recent call last):\n  File "/srv/cmulab/annotator/jobs.py", line 52\nValueError: audio is no longer cached\n'
+        failed = jobs.job_status_data(StubJob("failed", exc_info=exc_info))
+        self.assertEqual((failed["results"], failed["error"]), ([], "ValueError: audio is no longer cached"))
+        self.assertEqual(jobs.job_status_data(StubJob("failed"))["error"], "failed")
+
+    def test_jobs_belong_to_their_owner(self):
+        job = StubJob()
+        job.meta.update(jobs.owner_meta("alice"))
+        self.assertTrue(jobs.is_owner(job, "alice"))
+        self.assertFalse(jobs.is_owner(job, "bob"))
+        self.assertFalse(jobs.is_owner(StubJob(), ""))
 
-# Create your tests here.
@@ -0,0 +1,206 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import secrets
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+from annotator.BackendModels.feature_cache import media_dir
+
+# Resumable chunked uploads. Every upload gets a directory
+# UPLOAD_DIR/<upload_id>/ holding the file itself, written chunk by chunk at
+# its final location, and upload.json with its name, owner, expected size,
+# number of bytes received so far and, once complete, its SHA-256.
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", "")
+UPLOAD_BLOCK_BYTES = 1 << 20
+# Uploads (finished or not) are deleted once they have not been written to for this long
+UPLOAD_MAX_AGE_SECONDS = int(os.environ.get("UPLOAD_MAX_AGE_SECONDS", 24 * 3600))
+
+_upload_id_format = re.compile(r"^[0-9a-f]{32}$")
+# running SHA-256 of the uploads this process has been writing, with the
+# offset it covers; rebuilt from the file when a chunk arrives elsewhere
+_hashes = {}
+
+
+class UploadConflict(ValueError):
+    """ A chunk was sent for another offset than the one the upload is at. """
+
+    def __init__(self, meta):
+        super().__init__(f"upload {meta['upload_id']} is at offset {meta['offset']}")
+        self.meta = meta
+
+
+def upload_dir():
+    return UPLOAD_DIR or media_dir("uploads")
+
+
+def _meta_path(upload_id, root=None):
+    return os.path.join(root or upload_dir(), upload_id, "upload.json")
+
+
+def _save_meta(meta, root=None):
+    path = _meta_path(meta["upload_id"], root)
+    fd, tmp_path = tempfile.mkstemp(suffix='.json', dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, path)
+    return meta
+
+
+def upload_path(meta, root=None):
+    """ Path of the uploaded file. """
+    return os.path.join(root or upload_dir(), meta["upload_id"], meta["filename"])
+
+
+def start_upload(filename, size=None, root=None, owner=None):
+    """ Registers a new upload of filename (size in bytes, if known) by owner
+    (a user name), first deleting expired uploads.
+    Output is its metadata dict, with the upload_id to send chunks to.
+    """
+    cleanup_uploads(root=root)
+    # keep only the base name, so the file cannot end up outside its directory
+    filename = os.path.basename(filename.replace('\\', '/')).strip() or "upload"
+    if filename == "upload.json":
+        filename = "upload.json.data"
+    upload_id = secrets.token_hex(16)
+    meta = {"upload_id": upload_id, "filename": filename, "owner": owner, "size": size, "offset": 0, "complete": False, "sha256": None}
+    os.makedirs(os.path.join(root or upload_dir(), upload_id))
+    open(upload_path(meta, root), 'wb').close()
+    return _save_meta(meta, root)
+
+
+def get_upload(upload_id, root=None):
+    """ Metadata of an upload, or None if there is no such upload. """
+    if not _upload_id_format.match(str(upload_id)):
+        return None
+    try:
+        with open(_meta_path(upload_id, root)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def owned_upload(upload_id, owner, root=None):
+    """ Metadata of an upload started by owner (a user name), or None if there
+    is no such upload or it belongs to someone else.
+    """
+    meta = get_upload(upload_id, root)
+    if meta is None or not owner or meta.get("owner") != owner:
+        return None
+    return meta
+
+
+@contextmanager
+def _locked(meta, root=None):
+    """ The upload's file, opened for writing and locked against other
+    requests (in any process) for the same upload. Yields the file and the
+    metadata as saved, which may be ahead of meta.
+    """
+    with open(upload_path(meta, root), 'r+b') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield f, get_upload(meta["upload_id"], root)
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _running_hash(meta, root=None):
+    offset, sha = _hashes.get(meta["upload_id"], (None, None))
+    if offset != meta["offset"]:
+        # the earlier chunks were written by another process: hash them again
+        sha = hashlib.sha256()
+        with open(upload_path(meta, root), 'rb') as f:
+            remaining = meta["offset"]
+            while remaining > 0:
+                block = f.read(min(UPLOAD_BLOCK_BYTES, remaining))
+                if not block:
+                    break
+                sha.update(block)
+                remaining -= len(block)
+    return sha
+
+
+def append_chunk(meta, stream, root=None, offset=None):
+    """ Writes the bytes read from stream at the current end of the upload,
+    hashing them on the way, and completes the upload once its expected
+    size is reached. Raises UploadConflict if offset is given and the
+    upload is not there (e.g. a retried chunk that did arrive after all).
+    Output is the updated metadata. Nothing is recorded for a chunk that is
+    rejected or whose stream fails partway.
+    """
+    with _locked(meta, root) as (f, meta):
+        if meta["complete"]:
+            raise ValueError(f"upload {meta['upload_id']} is already complete")
+        if offset is not None and offset != meta["offset"]:
+            raise UploadConflict(meta)
+        # the running hash only takes this chunk once it has been written in full
+        sha = _running_hash(meta, root).copy()
+        start = end = meta["offset"]
+        # drop whatever a failed earlier attempt wrote past the last recorded offset
+        f.truncate(start)
+        f.seek(start)
+        try:
+            for block in iter(lambda: stream.read(UPLOAD_BLOCK_BYTES), b''):
+                if meta["size"] is not None and end + len(block) > meta["size"]:
+                    raise ValueError(f"upload {meta['upload_id']} is larger than the announced {meta['size']} bytes")
+                f.write(block)
+                sha.update(block)
+                end += len(block)
+            f.flush()
+        except BaseException:
+            f.truncate(start)
+            raise
+        meta["offset"] = end
+        _hashes[meta["upload_id"]] = (end, sha)
+        if meta["size"] is not None and end == meta["size"]:
+            return _finish(meta, root)
+        return _save_meta(meta, root)
+
+
+def _finish(meta, root=None):
+    if not meta["complete"]:
+        meta["sha256"] = _running_hash(meta, root).hexdigest()
+        meta["complete"] = True
+        _hashes.pop(meta["upload_id"], None)
+        _save_meta(meta, root)
+    return meta
+
+
+def finish_upload(meta, root=None):
+    """ Marks an upload complete and records its SHA-256. """
+    with _locked(meta, root) as (f, meta):
+        return _finish(meta, root)
+
+
+def remove_upload(upload_id, root=None):
+    _hashes.pop(upload_id, None)
+    shutil.rmtree(os.path.join(root or upload_dir(), upload_id), ignore_errors=True)
+
+
+def cleanup_uploads(max_age=UPLOAD_MAX_AGE_SECONDS, root=None):
+    """ Deletes the uploads that have not been written to for max_age seconds. """
+    root = root or upload_dir()
+    try:
+        upload_ids = [name for name in os.listdir(root) if _upload_id_format.match(name)]
+    except OSError:
+        return
+    now = time.time()
+    for upload_id in upload_ids:
+        try:
+            age = now - os.path.getmtime(_meta_path(upload_id, root))
+        except OSError:
+            # a directory without metadata is left by an interrupted start_upload
+            try:
+                age = now - os.path.getmtime(os.path.join(root, upload_id))
+            except OSError:
+                continue
+        if age > max_age:
+            remove_upload(upload_id, root)
+    # running hashes of uploads that were deleted by another process
+    for upload_id in list(_hashes):
+        if not os.path.exists(_meta_path(upload_id, root)):
+            _hashes.pop(upload_id, None)
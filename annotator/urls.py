@@ -54,6 +54,10 @@ urlpatterns = [
     path('annotator/ocr/', views.ocr_frontend, name='ocr_frontend'),
     path('annotator/download_file/<str:filename>', views.download_file, name='download_file'),
     path('annotator/kill_job/<str:job_id>', views.kill_job, name='kill_job'),
+    path('annotator/job_status/<str:job_id>', views.job_status, name='job_status'),
+    path('annotator/uploads/', views.start_upload, name='start_upload'),
+    path('annotator/uploads/<str:upload_id>', views.upload_chunk, name='upload_chunk'),
+    path('annotator/uploads/<str:upload_id>/complete', views.complete_upload, name='complete_upload'),
     path('annotator/profile', views.user_profile, name='user_profile'),
     path('annotator/get_model_ids', views.get_model_ids, name='get_model_ids'),
     path('annotator/translate', views.translate, name='translate'),
@@ -51,17 +51,25 @@ from annotator.models import Mlmodel, Corpus, Segment
 from annotator.models import Annotation, TextAnnotation, AudioAnnotation, SpanTextAnnotation
 
 from annotator.permissions import IsOwnerOrReadOnly
+from annotator import jobs
+from annotator import uploads
 
 from annotator.serializers import MlmodelSerializer, CorpusSerializer, SegmentSerializer, UserSerializer
 from annotator.serializers import AnnotationSerializer, AudioAnnotationSerializer, TextAnnotationSerializer, SpanTextAnnotationSerializer
 
 from annotator.BackendModels import MLModels
+from annotator.BackendModels import clips
+from annotator.BackendModels import diarization
+from annotator.BackendModels import finetune_data
+from annotator.BackendModels import feature_cache
 from annotator.models import Document, Transcript, UserProfile
 from annotator.forms import DocumentForm
 
 import django_rq
 from rq.command import send_stop_job_command
 from rq.job import Job
+from rq import get_current_job
+from rq.exceptions import NoSuchJobError
 
 from allosaurus.model import get_all_models
 from allosaurus.model import get_model_path
@@ -71,7 +79,6 @@ import traceback
 import json
 import string, secrets
 import glob
-import pydub
 import shutil
 import tempfile
 import datetime
@@ -106,6 +113,10 @@ ocr_api_usage = {}
 OCR_POST_CORRECTION = os.environ.get("OCR_POST_CORRECTION", "/ocr-post-correction/")
 OCR_API_USAGE_LIMIT = int(os.environ.get("OCR_API_USAGE_LIMIT", 100))
 IMAGE_SYNCHRONOUS_LIMIT = int(os.environ.get("IMAGE_SYNCHRONOUS_LIMIT", 10))
+# Phone transcription requests with more segments than this run as background
+# jobs; 0 (the default) only does so for clients that ask with params.async,
+# since older ELAN clients expect the transcriptions in the response
+PHONE_TRANSCRIPTION_SYNCHRONOUS_LIMIT = int(os.environ.get("PHONE_TRANSCRIPTION_SYNCHRONOUS_LIMIT", 0))
 COG_TRANSLATION_SERVER = os.environ.get("COG_TRANSLATION_SERVER", "http://172.17.0.1:5430/predictions")
 COG_GLOSSLM_SERVER = os.environ.get("COG_GLOSSLM_SERVER", "http://172.17.0.1:5431/predictions")
 MEDIA_ROOT = getattr(settings, "MEDIA_ROOT", "/tmp")
@@ -304,11 +315,16 @@ def dummy_python_job(msg):
 
 
 
-def batch_finetune_allosaurus(data_dir, log_file, pretrained_model, new_model_name, params, owner):
+def batch_finetune_allosaurus(archive_path, log_file, pretrained_model, new_model_name, params, owner, saved_filename=None):
+        """ Prepares the training data in archive_path (see finetune_data.prepare_dataset)
+        and fine-tunes pretrained_model on it. saved_filename is the archive's name in
+        FileSystemStorage if it was saved for this job, and is deleted once it is unpacked.
+        """
         print("Starting allosaurus fine-tuning job " + new_model_name)
         print("User: " + str(owner))
         print("User python type: " + str(type(owner)))
         tb = ""
+        data_dir = None
         fs = FileSystemStorage()
         with fs.open(log_file, 'w') as f_stdout:
                 with redirect_stderr(f_stdout):
@@ -320,8 +336,18 @@ def batch_finetune_allosaurus(data_dir, log_file, pretrained_model, new_model_na
                                         model1.save()
                                         print("New model ID: " + new_model_name)
                                         print(json.dumps(params, indent=4))
-                                        print("Fine-tuning Allosaurus...")
+                                        print("Preparing training data...")
+                                        data_dir = tempfile.mkdtemp(prefix="allosaurus-elan-")
                                         allosaurus_finetune = backend_models["allosaurus_finetune"]
+                                        # packed shards for plugins that read them, otherwise a wav and a txt per clip
+                                        dataset_format = finetune_data.plugin_dataset_format(allosaurus_finetune)
+                                        try:
+                                                num_clips = finetune_data.prepare_dataset([archive_path], data_dir, dataset_format=dataset_format)
+                                        finally:
+                                                if saved_filename:
+                                                        fs.delete(saved_filename)
+                                        print(f"{num_clips} training clips ({dataset_format})")
+                                        print("Fine-tuning Allosaurus...")
                                         allosaurus_finetune(data_dir, pretrained_model, new_model_name, params)
                                 except:
                                         tb = traceback.format_exc()
@@ -330,7 +356,7 @@ def batch_finetune_allosaurus(data_dir, log_file, pretrained_model, new_model_na
                 str_stdout = f_stdout.read()
         allosaurus_models = [model.name for model in get_all_models()]
         # TODO: ask user if we should delete this or keep
-        if os.path.exists(data_dir):
+        if data_dir and os.path.exists(data_dir):
                 shutil.rmtree(data_dir)
         if not tb and new_model_name in allosaurus_models:
                 model1.status=Mlmodel.READY
@@ -346,6 +372,109 @@ def batch_finetune_allosaurus(data_dir, log_file, pretrained_model, new_model_na
                 return msg
 
 
+def decode_upload(audio_file, fs):
+        """ (sha256, rate, samples) of an uploaded audio file, normalized to 16 kHz
+        mono. Audio already in the audio cache (same SHA-256) is neither saved
+        nor converted again. Returns None for non-WAV files when ffmpeg is missing.
+        """
+        digest = feature_cache.sha256_of_chunks(audio_file.chunks())
+        decoded = feature_cache.decoded_audio(digest)
+        if decoded is not None:
+                return (digest,) + decoded
+        if not audio_file.name.endswith('.wav') and not shutil.which('ffmpeg'):
+                return None
+        filename = fs.save(audio_file.name, audio_file)
+        print('absolute file path', fs.path(filename))
+        try:
+                return (digest,) + feature_cache.decode_cached(fs.path(filename), digest)
+        finally:
+                fs.delete(filename)
+
+
+def decode_upload_id(meta):
+        """ decode_upload for a finished chunked upload, which stays where it is. """
+        path = uploads.upload_path(meta)
+        if not path.endswith('.wav') and not shutil.which('ffmpeg') and feature_cache.decoded_audio(meta["sha256"]) is None:
+                return None
+        return (meta["sha256"],) + feature_cache.decode_cached(path, meta["sha256"])
+
+
+def completed_uploads(request, field="file"):
+        """ Metadata of the finished chunked uploads whose ids were sent as
+        <field>_upload_id; None if any of them is unknown, incomplete or was
+        not uploaded by request.user.
+        """
+        metas = []
+        for upload_id in request.POST.getlist(field + "_upload_id"):
+                meta = owned_upload(request, upload_id)
+                if meta is None or not meta["complete"]:
+                        return None
+                metas.append(meta)
+        return metas
+
+
+def saved_files(request, fs, field="file"):
+        """ (name, path, saved name) of every file sent in field, saved through fs,
+        followed by every finished chunked upload sent as <field>_upload_id
+        (with saved name None, as it must not be deleted). None if one of the
+        upload ids is unknown, its upload is incomplete or belongs to another
+        user than request.user.
+        """
+        metas = completed_uploads(request, field)
+        if metas is None:
+                return None
+        files = []
+        for uploaded_file in request.FILES.getlist(field):
+                filename = fs.save(uploaded_file.name, uploaded_file)
+                files.append((uploaded_file.name, fs.path(filename), filename))
+        for meta in metas:
+                files.append((meta["filename"], uploads.upload_path(meta), None))
+        return files
+
+
+def invalid_audio_hashes(request):
+        """ The audio_sha256 values the client sent that are not hex SHA-256 digests. """
+        return [digest for digest in request.POST.getlist("audio_sha256") if not feature_cache.is_sha256(digest)]
+
+
+def decoded_audio_by_hash(request):
+        """ (sha256, rate, samples) for every audio_sha256 the client sent instead
+        of uploading a file the server already holds; None if any is unknown.
+        """
+        decoded = []
+        for digest in request.POST.getlist("audio_sha256"):
+                found = feature_cache.decoded_audio(digest)
+                if found is None:
+                        return None
+                decoded.append((digest,) + found)
+        return decoded
+
+
+def phone_transcription_job(digests, segments, params):
+        """ phone_transcription as a background job, for audio in the audio cache.
+        While it runs, the job's meta holds its progress (segments done out of
+        total, for file number `file` of `files`) and the transcriptions
+        finished so far, which job_status reports.
+        """
+        return jobs.transcribe_cached_audio(get_current_job(), backend_models["allosaurus"], digests, segments, params)
+
+
+def diarization_job(files, segments, speakers, params, saved_filenames=()):
+        """ Batch diarization as a background job: every (name, source) in files
+        goes through diarization.diarize_files, spread over DIARIZATION_WORKERS
+        processes. The job's meta holds its progress (files done out of total)
+        and the results so far, keyed by file name, which job_status reports.
+        Uploads saved for the job are deleted once it is done.
+        """
+        progress = jobs.progress_reporter(get_current_job())
+        try:
+                return diarization.diarize_files(backend_models["diarization"], files, segments, speakers, params, progress=progress)
+        finally:
+                fs = FileSystemStorage()
+                for filename in saved_filenames:
+                        fs.delete(filename)
+
+
 # @login_required(login_url='/annotator/login/')
 @api_view(['GET', 'PUT', 'POST'])
 def annotate(request, mk, sk):
@@ -395,6 +524,9 @@ def annotate(request, mk, sk):
                         print(e)
                         return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         elif request.method == 'POST':
+                # chunked uploads are only handed to the user who uploaded them
+                if any(key.endswith("_upload_id") for key in request.POST) and not authenticate_token(request):
+                        return Response(status=status.HTTP_401_UNAUTHORIZED)
                 try:
                         # modeltag = model.tags
                         params = json.loads(request.POST.get("params", '{}'))
@@ -407,12 +539,58 @@ def annotate(request, mk, sk):
                                         speakers.append(annotation["value"].strip())
                                         segments.append([float(annotation["start"]), float(annotation["end"])])
                                 fs = FileSystemStorage()
-                                for audio_file in request.FILES.getlist('file'):
-                                        filename = fs.save(audio_file.name, audio_file)
-                                        uploaded_file_path = fs.path(filename)
-                                        print('absolute file path', uploaded_file_path)
-                                        diarization_model = backend_models["diarization"]
-                                        response_data = diarization_model(str(uploaded_file_path), segments, speakers)
+                                diarization_model = backend_models["diarization"]
+                                saved_filenames = []
+                                if clips.audio_input(diarization_model) == clips.AUDIO_INPUT_ARRAY:
+                                        # array plugins get the audio from the audio cache, by hash
+                                        if invalid_audio_hashes(request):
+                                                return Response("invalid audio_sha256", status=status.HTTP_400_BAD_REQUEST)
+                                        decoded_audio = decoded_audio_by_hash(request)
+                                        if decoded_audio is None:
+                                                return Response("audio not found on the server, please upload the file", status=status.HTTP_404_NOT_FOUND)
+                                        upload_metas = completed_uploads(request)
+                                        if upload_metas is None:
+                                                return Response("unknown or incomplete upload", status=status.HTTP_404_NOT_FOUND)
+                                        names = request.POST.getlist("audio_sha256")
+                                        for audio_file in request.FILES.getlist('file'):
+                                                decoded_audio.append(decode_upload(audio_file, fs))
+                                                names.append(audio_file.name)
+                                        decoded_audio += [decode_upload_id(meta) for meta in upload_metas]
+                                        names += [meta["filename"] for meta in upload_metas]
+                                        if any(d is None for d in decoded_audio):
+                                                return Response("only WAV files are supported!", status=status.HTTP_400_BAD_REQUEST)
+                                        sources = [d[0] for d in decoded_audio]
+                                else:
+                                        audio_files = saved_files(request, fs)
+                                        if audio_files is None:
+                                                return Response("unknown or incomplete upload", status=status.HTTP_404_NOT_FOUND)
+                                        names = [name for (name, _, _) in audio_files]
+                                        sources = [uploaded_file_path for (_, uploaded_file_path, _) in audio_files]
+                                        saved_filenames = [filename for (_, _, filename) in audio_files if filename]
+                                        if not sources and request.POST.getlist("audio_sha256"):
+                                                return Response("audio_sha256 is only supported for array plugins, please upload the file",
+                                                                status=status.HTTP_400_BAD_REQUEST)
+                                if len(sources) > 1 or params.get("async"):
+                                        # several files: diarize them in parallel in a background job, results keyed by file name via job_status
+                                        # job_status only reports the job to the user who started it
+                                        if not authenticate_token(request):
+                                                for filename in saved_filenames:
+                                                        fs.delete(filename)
+                                                return Response(status=status.HTTP_401_UNAUTHORIZED)
+                                        files = list(zip(diarization.unique_names(names), sources))
+                                        suffix = ''.join(secrets.choice(string.ascii_letters + string.digits) for i in range(8))
+                                        job_id = "diarization_" + datetime.datetime.now().strftime("%Y%m%d%H%M%S%f") + "_" + suffix
+                                        job = django_rq.enqueue(diarization_job, files, segments, speakers, params, saved_filenames,
+                                                                job_id=job_id, result_ttl=-1, meta=jobs.owner_meta(request.user.get_username()))
+                                        return Response([{
+                                                "job_id": job_id,
+                                                "status_url": "/annotator/job_status/" + job_id,
+                                                "status": job.get_status()}], status=status.HTTP_202_ACCEPTED)
+                                response_data = None
+                                for source in sources:
+                                        print('audio', source)
+                                        response_data = diarization.diarize(diarization_model, source, segments, speakers, params)
+                                for filename in saved_filenames:
                                         fs.delete(filename)
                                 return Response(response_data, status=status.HTTP_202_ACCEPTED)
 
@@ -437,39 +615,36 @@ def annotate(request, mk, sk):
                                 # audio_file = '/home/user/Downloads/delete/DSTA-project/ELAN_6-1/lib/app/extensions/allosaurus-elan/test/allosaurus.wav'
                                 # audio_file = request.FILES['file']
                                 fs = FileSystemStorage()
-                                tmp_dir = tempfile.mkdtemp(prefix="allosaurus-elan-")
+                                if invalid_audio_hashes(request):
+                                        return Response("invalid audio_sha256", status=status.HTTP_400_BAD_REQUEST)
+                                decoded_audio = decoded_audio_by_hash(request)
+                                if decoded_audio is None:
+                                        return Response("audio not found on the server, please upload the file", status=status.HTTP_404_NOT_FOUND)
+                                upload_metas = completed_uploads(request)
+                                if upload_metas is None:
+                                        return Response("unknown or incomplete upload", status=status.HTTP_404_NOT_FOUND)
                                 for audio_file in request.FILES.getlist('file'):
-                                        filename = fs.save(audio_file.name, audio_file)
-                                        uploaded_file_path = fs.path(filename)
-                                        print('absolute file path', uploaded_file_path)
-                                        if not uploaded_file_path.endswith('.wav'):
-                                                converted_audio_file = tempfile.NamedTemporaryFile(suffix = '.wav')
-                                                ffmpeg = shutil.which('ffmpeg')
-                                                if ffmpeg:
-                                                        subprocess.call([ffmpeg, '-y', '-v', '0', '-i', uploaded_file_path,'-ac', '1', '-ar', '16000', '-sample_fmt', 's16', '-acodec', 'pcm_s16le', converted_audio_file.name])
-                                                else:
-                                                        return Response("only WAV files are supported!", status=status.HTTP_400_BAD_REQUEST)
-                                        else:
-                                                converted_audio_file = open(uploaded_file_path, mode='rb')
-                                        converted_audio = pydub.AudioSegment.from_file(converted_audio_file, format = 'wav')
-                                        response_data = []
-                                        if not segments:
-                                                segments = [{'start': 0, 'end': len(converted_audio), 'value': ""}]
-                                        for annotation in segments:
-                                                annotation['clip'] = tempfile.NamedTemporaryFile(suffix = '.wav', dir = tmp_dir, delete=False)
-                                                clip = converted_audio[annotation['start']:annotation['end']]
-                                                clip.export(annotation['clip'], format = 'wav')
-                                                print(annotation['clip'].name)
-                                                # trans_model.get_results(annotation['clip'].name)
-                                                trans_model_output = trans_model(annotation['clip'].name, params=params)
-                                                response_data.append({
-                                                        "start": annotation['start'],
-                                                        "end": annotation['end'],
-                                                        "transcription": trans_model_output
-                                                })
-                                        fs.delete(filename)
-                                        if os.path.exists(converted_audio_file.name):
-                                                os.remove(converted_audio_file.name)
+                                        decoded_audio.append(decode_upload(audio_file, fs))
+                                decoded_audio += [decode_upload_id(meta) for meta in upload_metas]
+                                if any(d is None for d in decoded_audio):
+                                        return Response("only WAV files are supported!", status=status.HTTP_400_BAD_REQUEST)
+                                if params.get("async") or 0 < PHONE_TRANSCRIPTION_SYNCHRONOUS_LIMIT < len(segments):
+                                        # long recordings: return a job id at once, progress and partial results via job_status
+                                        if not authenticate_token(request):
+                                                return Response(status=status.HTTP_401_UNAUTHORIZED)
+                                        suffix = ''.join(secrets.choice(string.ascii_letters + string.digits) for i in range(8))
+                                        job_id = "phone_transcription_" + datetime.datetime.now().strftime("%Y%m%d%H%M%S%f") + "_" + suffix
+                                        job = django_rq.enqueue(phone_transcription_job, [d[0] for d in decoded_audio], segments, params,
+                                                                job_id=job_id, result_ttl=-1, meta=jobs.owner_meta(request.user.get_username()))
+                                        return Response([{
+                                                "job_id": job_id,
+                                                "status_url": "/annotator/job_status/" + job_id,
+                                                "status": job.get_status()}], status=status.HTTP_202_ACCEPTED)
+                                tmp_dir = tempfile.mkdtemp(prefix="allosaurus-elan-")
+                                for (_, rate, samples) in decoded_audio:
+                                        # decoded once to 16 kHz mono; clips are sliced from that buffer and passed
+                                        # to the plugin in memory, unless it declared that it needs wav files
+                                        response_data = clips.transcribe(trans_model, rate, samples, segments, params, tmp_dir=tmp_dir)
                                 if os.path.exists(tmp_dir):
                                         shutil.rmtree(tmp_dir)
                                 return Response(response_data, status=status.HTTP_202_ACCEPTED)
@@ -479,33 +654,13 @@ def annotate(request, mk, sk):
                                 default_params = '{"lang": "eng", "epoch": 2, "pretrained_model": "uni2005"}'
                                 params = json.loads(request.POST.get("params", default_params))
                                 fs = FileSystemStorage()
-                                tmp_dir = tempfile.mkdtemp(prefix="allosaurus-elan-")
                                 if params.get("service") == "batch_finetune":
-                                        for zip_file in request.FILES.getlist('file'):
-                                                tmp_dir2 = tempfile.mkdtemp(prefix="allosaurus-elan-")
-                                                # TODO: remove files afterwards
-                                                filename = fs.save(zip_file.name, zip_file)
-                                                uploaded_file_path = fs.path(filename)
+                                        zip_files = saved_files(request, fs)
+                                        if zip_files is None:
+                                                return Response("unknown or incomplete upload", status=status.HTTP_404_NOT_FOUND)
+                                        for (_, uploaded_file_path, filename) in zip_files:
+                                                # unpacking and slicing the archive is left to the job, see batch_finetune_allosaurus
                                                 print('absolute file path', uploaded_file_path)
-                                                print('temp dir', tmp_dir)
-                                                print('temp dir 2', tmp_dir2)
-                                                shutil.unpack_archive(uploaded_file_path, tmp_dir)
-                                                train_dir_path = Path(tmp_dir2) / "train"
-                                                validate_dir_path = Path(tmp_dir2) / "validate"
-                                                train_dir_path.mkdir(parents=True, exist_ok=True)
-                                                for wav_file in glob.glob(tmp_dir + "/train/*.wav"):
-                                                        full_audio = pydub.AudioSegment.from_file(wav_file, format = 'wav')
-                                                        json_file = os.path.splitext(wav_file)[0] + ".json"
-                                                        with open(json_file, 'r') as fjson:
-                                                                transcriptions = json.load(fjson)
-                                                        for start_end in transcriptions:
-                                                                start, end = map(int, start_end.split('-'))
-                                                                transcription = transcriptions[start_end][0]
-                                                                segment_id = os.path.basename(os.path.splitext(wav_file)[0]) + '_' + start_end
-                                                                clip = full_audio[start:end]
-                                                                clip.export(train_dir_path / (segment_id + ".wav"), format = 'wav')
-                                                                (train_dir_path / (segment_id + ".txt")).write_text(transcription)
-                                                shutil.copytree(train_dir_path.resolve(), validate_dir_path.resolve())
                                                 allosaurus_finetune = backend_models["allosaurus_finetune"]
                                                 pretrained_model = params.get("pretrained_model", "uni2005")
                                                 # new_model_id = pretrained_model + "_" + datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
@@ -526,13 +681,10 @@ def annotate(request, mk, sk):
                                                 print("User: " + str(request.user))
                                                 print("User python type: " + str(type(request.user)))
                                                 log_file = "allosaurus_finetune_" + new_model_id + "_log.txt"
-                                                job = django_rq.enqueue(batch_finetune_allosaurus, tmp_dir2, log_file, pretrained_model, new_model_id, params, request.user,
-                                                                        job_id=job_id, result_ttl=-1)
+                                                job = django_rq.enqueue(batch_finetune_allosaurus, uploaded_file_path, log_file, pretrained_model, new_model_id, params, request.user,
+                                                                        filename, job_id=job_id, result_ttl=-1)
                                                 print('fine-tuned model ID', new_model_id)
                                                 print('RQ job ID', job_id)
-                                                fs.delete(filename)
-                                        if os.path.exists(tmp_dir):
-                                                shutil.rmtree(tmp_dir)
                                         return Response([{"new_model_id": new_model_id,
                                                 "job_id": job_id,
                                                 "status_url": "/annotator/media/" + log_file,
@@ -541,6 +693,7 @@ def annotate(request, mk, sk):
                                                 "status": job.get_status()}], status=status.HTTP_202_ACCEPTED)
                                 else:
                                         # old version of fine-tuning service, no longer used TODO: DELETE THIS
+                                        tmp_dir = tempfile.mkdtemp(prefix="allosaurus-elan-")
                                         for zip_file in request.FILES.getlist('file'):
                                                 filename = fs.save(zip_file.name, zip_file)
                                                 uploaded_file_path = fs.path(filename)
@@ -650,20 +803,22 @@ def ocr_post_correction(request):
         fileids = json.loads(request.POST.get("fileids", "{}"))
         fs = FileSystemStorage()
         images = []
-        for uploaded_file in request.FILES.getlist('file'):
+        uploaded_files = saved_files(request, fs)
+        if uploaded_files is None:
+            return Response("unknown or incomplete upload", status=status.HTTP_404_NOT_FOUND)
+        for (name, filepath, saved_name) in uploaded_files:
             if params.get("store_files", True):
                 # TODO: save these files (along with transcripts)
-                newdoc = Document(docfile = uploaded_file)
+                newdoc = Document()
+                newdoc.docfile.name = stored_document_name(name, filepath, saved_name, fs)
                 newdoc.owner = request.user
                 newdoc.save()
-            filename = fs.save(uploaded_file.name, uploaded_file)
-            filepath = fs.path(filename)
-            fileids[filepath] = fileids.get(uploaded_file.name, os.path.basename(filepath))
-            if uploaded_file.name.endswith('.pdf'):
+            fileids[filepath] = fileids.get(name, os.path.basename(filepath))
+            if name.endswith('.pdf'):
                 # TODO: cleanup tmpdir?
                 tmp_dir = tempfile.mkdtemp(prefix="pdf2image_")
-                images += convert_from_path(filepath, dpi=400, paths_only=True, fmt='png', output_file=uploaded_file.name + '_', output_folder=tmp_dir)
-            elif uploaded_file.name.endswith('.zip'):
+                images += convert_from_path(filepath, dpi=400, paths_only=True, fmt='png', output_file=name + '_', output_folder=tmp_dir)
+            elif name.endswith('.zip'):
                 # TODO: cleanup tmpdir?
                 tmp_dir = tempfile.mkdtemp(prefix="zipped_images_")
                 print(f"Unzipping images from {filepath} to {tmp_dir}")
@@ -693,6 +848,22 @@ def ocr_post_correction(request):
         return Response(text, status=status.HTTP_202_ACCEPTED)
 
 
+def stored_document_name(name, filepath, saved_name, fs):
+    """ Name under MEDIA_ROOT a Document can point at without another copy of
+    the file: the name it was saved under, or, for a chunked upload (which
+    expires, and may live outside MEDIA_ROOT), a hard link to it in documents/.
+    """
+    if saved_name:
+        return saved_name
+    doc_name = fs.get_available_name(os.path.join("documents", datetime.date.today().strftime("%Y/%m/%d"), name))
+    os.makedirs(os.path.dirname(fs.path(doc_name)), exist_ok=True)
+    try:
+        os.link(filepath, fs.path(doc_name))
+    except OSError:
+        shutil.copyfile(filepath, fs.path(doc_name))
+    return doc_name
+
+
 def send_job_completion_email(email, subject, message, attachment):
     # if '@' in email:
     email_format = r"(^[a-zA-Z0-9'_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)"
@@ -787,9 +958,12 @@ def test_single_source_ocr(request):
     if not os.path.exists(model_dir):
         return Response("Specified model ID does not exist or is no longer available!", status=status.HTTP_400_BAD_REQUEST)
 
-    test_data = request.FILES['testData']
-    test_filename = fs.save(test_data.name, test_data)
-    test_filepath = fs.path(test_filename)
+    test_data = saved_files(request, fs, 'testData')
+    if test_data is None:
+        return Response("unknown or incomplete upload", status=status.HTTP_404_NOT_FOUND)
+    if not test_data:
+        return Response("Test data not specified!", status=status.HTTP_400_BAD_REQUEST)
+    test_filepath = test_data[0][1]
     params = {
         "test_file": test_filepath,
         "model_dir": model_dir,
@@ -851,16 +1025,17 @@ def train_single_source_ocr(request):
     user_params = json.loads(request.POST.get("params", "{}"))
     debug = user_params.get("debug", False)
     email = request.POST.get("email", "")
-    src_data = request.FILES['srcData']
-    src_filename = fs.save(src_data.name, src_data)
-    src_filepath = fs.path(src_filename)
-    tgt_data = request.FILES['tgtData']
-    tgt_filename = fs.save(tgt_data.name, tgt_data)
-    tgt_filepath = fs.path(tgt_filename)
-    unlabeled_data = request.FILES.get('unlabeledData')
+    src_data = saved_files(request, fs, 'srcData')
+    tgt_data = saved_files(request, fs, 'tgtData')
+    unlabeled_data = saved_files(request, fs, 'unlabeledData')
+    if src_data is None or tgt_data is None or unlabeled_data is None:
+        return Response("unknown or incomplete upload", status=status.HTTP_404_NOT_FOUND)
+    if not src_data or not tgt_data:
+        return Response("Source or target data not specified!", status=status.HTTP_400_BAD_REQUEST)
+    src_filepath = src_data[0][1]
+    tgt_filepath = tgt_data[0][1]
     if unlabeled_data:
-        unlabeled_filename = fs.save(unlabeled_data.name, unlabeled_data)
-        unlabeled_filepath = fs.path(unlabeled_filename)
+        unlabeled_filepath = unlabeled_data[0][1]
     else:
         # TODO: update training script to skip pre-training if unlabeled data is not provided
         unlabeled_filepath = src_filepath
@@ -1036,6 +1211,94 @@ def kill_job(request, job_id):
     return Response(response_data)
 
 
+@api_view(['GET'])
+@never_cache
+def job_status(request, job_id):
+    if not authenticate_token(request):
+        return HttpResponse("Unauthorized", status=status.HTTP_401_UNAUTHORIZED)
+    queue = django_rq.queues.get_queue('default')
+    try:
+        job = Job.fetch(job_id, connection=queue.connection)
+    except NoSuchJobError:
+        job = None
+    # other users' jobs are reported as missing
+    if job is None or not jobs.is_owner(job, request.user.get_username()):
+        return Response({"job_id": job_id, "status": "not found"}, status=status.HTTP_404_NOT_FOUND)
+    return Response(jobs.job_status_data(job))
+
+
+def authenticate_token(request):
+    """ Sets request.user from the Authorization token; False if there is no valid one. """
+    auth_token = request.META.get('HTTP_AUTHORIZATION', '').strip()
+    if not auth_token:
+        return False
+    try:
+        request.user = Token.objects.get(key=auth_token).user
+    except Token.DoesNotExist:
+        return False
+    return True
+
+
+def owned_upload(request, upload_id):
+    """ Metadata of an upload started by request.user, or None. """
+    return uploads.owned_upload(upload_id, request.user.get_username())
+
+
+@api_view(['POST'])
+@csrf_exempt
+def start_upload(request):
+    if not authenticate_token(request):
+        return HttpResponse("Unauthorized", status=status.HTTP_401_UNAUTHORIZED)
+    filename = request.POST.get("filename", "")
+    if not filename:
+        return Response("File name not specified!", status=status.HTTP_400_BAD_REQUEST)
+    try:
+        size = int(request.POST["size"]) if request.POST.get("size") else None
+    except ValueError:
+        return Response("Invalid file size!", status=status.HTTP_400_BAD_REQUEST)
+    meta = uploads.start_upload(filename, size, owner=request.user.get_username())
+    return Response(meta, status=status.HTTP_201_CREATED)
+
+
+@api_view(['GET', 'PUT'])
+@csrf_exempt
+@never_cache
+def upload_chunk(request, upload_id):
+    # GET tells a client where to resume, PUT appends the request body at ?offset=
+    if not authenticate_token(request):
+        return HttpResponse("Unauthorized", status=status.HTTP_401_UNAUTHORIZED)
+    meta = owned_upload(request, upload_id)
+    if meta is None:
+        return Response({"upload_id": upload_id, "status": "not found"}, status=status.HTTP_404_NOT_FOUND)
+    if request.method == 'GET':
+        return Response(meta)
+    try:
+        offset = int(request.GET.get("offset", meta["offset"]))
+    except ValueError:
+        return Response("Invalid offset!", status=status.HTTP_400_BAD_REQUEST)
+    try:
+        # the offset is checked again under the upload's lock, in case a retry of the same chunk is being written
+        meta = uploads.append_chunk(meta, request.stream or io.BytesIO(), offset=offset)
+    except uploads.UploadConflict as e:
+        return Response(e.meta, status=status.HTTP_409_CONFLICT)
+    except ValueError as e:
+        return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+    return Response(meta)
+
+
+@api_view(['POST'])
+@csrf_exempt
+def complete_upload(request, upload_id):
+    if not authenticate_token(request):
+        return HttpResponse("Unauthorized", status=status.HTTP_401_UNAUTHORIZED)
+    meta = owned_upload(request, upload_id)
+    if meta is None:
+        return Response({"upload_id": upload_id, "status": "not found"}, status=status.HTTP_404_NOT_FOUND)
+    if meta["size"] is not None and meta["offset"] != meta["size"]:
+        return Response(meta, status=status.HTTP_409_CONFLICT)
+    return Response(uploads.finish_upload(meta))
+
+
 def download_file(request, filename):
     fs = FileSystemStorage()
     filepath = fs.path(filename)